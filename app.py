@@ -7,23 +7,134 @@ import jellyfish
 from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
 from dotenv import load_dotenv
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
 import gspread
 from google.oauth2.service_account import Credentials
 from datetime import datetime, timedelta
+import profiler
+from catalog import (
+    is_available,
+    normalize_model_name,
+    normalize_storage,
+    normalize_color,
+    find_matching_products,
+    get_available_storages,
+    get_available_colors,
+    ColumnarCatalog,
+    parse_storage_gb,
+    parse_price,
+    find_similar_models,
+    extract_models_from_input
+)
 import logging
-import difflib
+import logging.handlers
+import atexit
+import random
+import math
 import uuid
+import sqlite3
+import gc
+import gzip
+import hashlib
+import hmac
 import time
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+import threading
+import queue
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import cached_property, wraps
 
 # Load environment variables
 load_dotenv()
+
+# Logging: records are queued by request threads and formatted/written as JSON
+# on a background thread. Noisy categories are sampled and long messages are
+# truncated.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_MAX_MESSAGE_LENGTH = int(os.getenv("LOG_MAX_MESSAGE_LENGTH", "1000"))
+LOG_SAMPLE_RATES = {
+    "ai_response": float(os.getenv("LOG_SAMPLE_AI_RESPONSE", "0.1")),
+    "catalog_sample": float(os.getenv("LOG_SAMPLE_CATALOG", "0.05")),
+    "session_cleanup": float(os.getenv("LOG_SAMPLE_SESSION_CLEANUP", "0.01")),
+    "llm_usage": float(os.getenv("LOG_SAMPLE_LLM_USAGE", "1.0"))
+}
+
+class SamplingFilter(logging.Filter):
+    """Drop a share of records tagged with a sampled `log_category`.
+    Warnings and errors are never dropped."""
+    def filter(self, record):
+        category = getattr(record, "log_category", None)
+        if category is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < LOG_SAMPLE_RATES.get(category, 1.0)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        message = record.getMessage()
+        if len(message) > LOG_MAX_MESSAGE_LENGTH:
+            message = f"{message[:LOG_MAX_MESSAGE_LENGTH]}... [truncated {len(message) - LOG_MAX_MESSAGE_LENGTH} chars]"
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": message
+        }
+        category = getattr(record, "log_category", None)
+        if category:
+            entry["category"] = category
+        fields = getattr(record, "log_fields", None)
+        if fields:
+            entry["fields"] = fields
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records unformatted; the listener thread does all formatting"""
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.handlers = [queue_handler]
+    root_logger.setLevel(LOG_LEVEL)
+    listener.start()
+    return listener
+
+# The listener thread is per process: started by create_app()/init_worker(),
+# and again in each worker after a fork
+log_listener = None
+log_listener_pid = None
+
+def start_logging():
+    global log_listener, log_listener_pid
+    if log_listener_pid == os.getpid():
+        return
+    log_listener = setup_logging()
+    log_listener_pid = os.getpid()
+
+def stop_logging():
+    """Flush queued records and stop this process's listener thread"""
+    global log_listener, log_listener_pid
+    if log_listener_pid == os.getpid():
+        log_listener.stop()
+    log_listener = None
+    log_listener_pid = None
+
+atexit.register(stop_logging)
+logger = logging.getLogger(__name__)
+
 TOGETHER_API_KEY = os.getenv("API")
 PRODUCT_SHEET_URL = os.getenv("PRODUCT_SHEET_URL")
 ORDER_SHEET_URL = os.getenv("ORDER_SHEET_URL")
@@ -36,51 +147,175 @@ CORS(app, resources={r"/*": {"origins": "https://sitetest-76es.onrender.com "}})
 # Google Sheets Setup
 scopes = ['https://www.googleapis.com/auth/spreadsheets ']
 service_account_info = None
-gc = None
-product_sheet = None
-order_sheet = None
+SHEETS_QUOTA_PER_MINUTE = int(os.getenv("SHEETS_QUOTA_PER_MINUTE", "60"))
+# The quota is per Google project, so every process of the deployment counts
+# its requests in one SQLite file
+SHEETS_QUOTA_PATH = os.getenv("SHEETS_QUOTA_PATH", os.getenv("ORDER_MIRROR_PATH", "orders.db"))
+SHEETS_REQUEST_TIMEOUT = 60  # seconds a caller waits for a scheduled operation
 
-def initialize_google_sheets():
-    global service_account_info, gc, product_sheet, order_sheet
-    try:
-        # Parse service account JSON from environment variable
-        service_account_info = json.loads(SERVICE_ACCOUNT_JSON)
-        credentials = Credentials.from_service_account_info(
-            service_account_info,
-            scopes=scopes
-        )
-        gc = gspread.authorize(credentials)
-        
-        # Initialize sheets with retry logic
-        max_retries = 3
-        for attempt in range(max_retries):
+def is_quota_error(error):
+    return "RESOURCE_EXHAUSTED" in str(error) or "429" in str(error)
+
+class SharedQuotaWindow:
+    """Sliding one-minute window of Sheets requests, kept in SQLite so all
+    processes sharing the file stay under one per-minute quota together"""
+    def __init__(self, path, per_minute):
+        self.path = path
+        self.per_minute = per_minute
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def acquire(self, cost):
+        """Record `cost` requests and return 0 if they fit in the window,
+        else the seconds until the oldest request leaves it"""
+        with self.lock:
+            return self.acquire_locked(cost)
+
+    def acquire_locked(self, cost):
+        if self.connection is None:
+            # Opened on first use, in the process that uses it
+            self.connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sheets_requests (requested_at REAL NOT NULL)"
+            )
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("DELETE FROM sheets_requests WHERE requested_at <= ?", (now - 60,))
+            count, oldest = self.connection.execute(
+                "SELECT COUNT(*), MIN(requested_at) FROM sheets_requests"
+            ).fetchone()
+            if count + cost <= self.per_minute:
+                self.connection.executemany(
+                    "INSERT INTO sheets_requests (requested_at) VALUES (?)", [(now,)] * cost
+                )
+                return 0
+            return max(60 - (now - oldest), 0.1)
+        finally:
+            self.connection.execute("COMMIT")
+
+class SheetsScheduler:
+    """Owns the gspread client and runs all Sheets I/O on one worker thread.
+
+    Operations are callables taking the scheduler, so they always use the
+    current client after a reconnect. Order writes are scheduled ahead
+    of catalog reads, identical pending reads share one request, and quota
+    tracking and backoff happen here rather than at each call site.
+    """
+    WRITE_PRIORITY = 0
+    READ_PRIORITY = 1
+
+    def __init__(self, quota_per_minute, max_retries=5):
+        self.quota = SharedQuotaWindow(SHEETS_QUOTA_PATH, quota_per_minute)
+        self.max_retries = max_retries
+        self.gc = None
+        self.generation = 0  # bumped on every (re)connect; sheet handles of older generations are stale
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.pending_reads = {}
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def connect(self):
+        global service_account_info
+        try:
+            # Parse service account JSON from environment variable
+            service_account_info = json.loads(SERVICE_ACCOUNT_JSON)
+            credentials = Credentials.from_service_account_info(
+                service_account_info,
+                scopes=scopes
+            )
+            self.gc = gspread.authorize(credentials)
+            self.generation += 1
+            logger.info("Successfully connected to Google Sheets")
+            return True
+        except Exception as e:
+            logger.error("Google Sheets connection failed: %s", e)
+            return False
+
+    def wait_for_quota(self, cost=1):
+        """Block until `cost` more requests fit in the per-minute quota"""
+        while True:
+            wait_time = self.quota.acquire(cost)
+            if not wait_time:
+                return
+            logger.info("Sheets quota reached, waiting %.1f seconds", wait_time)
+            time.sleep(wait_time)
+
+    def execute(self, operation, quota_cost=1, reconnect=True):
+        """Run an operation in the calling thread with quota tracking and
+        exponential backoff on RESOURCE_EXHAUSTED"""
+        for attempt in range(self.max_retries):
+            self.wait_for_quota(quota_cost)
             try:
-                # Open by URL with error handling
-                product_sheet = gc.open_by_url(PRODUCT_SHEET_URL).sheet1
-                order_sheet = gc.open_by_url(ORDER_SHEET_URL).sheet1
-                logger.info("Successfully connected to Google Sheets")
-                return True
+                return operation(self)
             except gspread.exceptions.APIError as e:
-                logger.warning(f"Google Sheets API error (attempt {attempt+1}): {str(e)}")
-                if "RESOURCE_EXHAUSTED" in str(e):
+                logger.warning("Google Sheets API error (attempt %d): %s", attempt + 1, e)
+                if is_quota_error(e) and attempt < self.max_retries - 1:
                     wait_time = 2 ** attempt  # Exponential backoff
-                    logger.info(f"Waiting {wait_time} seconds before retry...")
+                    logger.info("Waiting %s seconds before retry...", wait_time)
                     time.sleep(wait_time)
+                elif "UNAUTHENTICATED" in str(e) and reconnect and attempt < self.max_retries - 1:
+                    logger.warning("Reinitializing Google Sheets connection")
+                    self.connect()
                 else:
                     raise
-        logger.error("Google Sheets connection failed after multiple retries")
-        return False
-    except Exception as e:
-        logger.error(f"Google Sheets connection failed: {str(e)}")
-        return False
 
-# Initialize Google Sheets connection
-if not initialize_google_sheets():
-    exit(1)
+    def submit(self, operation, priority, key=None):
+        """Queue an operation and return a Future for its result"""
+        with self.lock:
+            if key is not None and key in self.pending_reads:
+                return self.pending_reads[key]
+            future = Future()
+            if key is not None:
+                self.pending_reads[key] = future
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self.run,
+                    name="sheets-scheduler",
+                    daemon=True
+                )
+                self.worker.start()
+        self.queue.put((priority, next(self.sequence), operation, key, future))
+        return future
+
+    def read(self, key, operation):
+        return self.submit(operation, self.READ_PRIORITY, key=key)
+
+    def write(self, operation):
+        return self.submit(operation, self.WRITE_PRIORITY)
+
+    def run(self):
+        while True:
+            _, _, operation, key, future = self.queue.get()
+            # Skip operations whose caller gave up and cancelled them
+            if not future.set_running_or_notify_cancel():
+                if key is not None:
+                    with self.lock:
+                        self.pending_reads.pop(key, None)
+                continue
+            try:
+                result = self.execute(operation)
+                error = None
+            except Exception as e:
+                error = e
+            # Later reads must trigger a fresh request
+            if key is not None:
+                with self.lock:
+                    self.pending_reads.pop(key, None)
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+sheets_scheduler = SheetsScheduler(SHEETS_QUOTA_PER_MINUTE)
+
+def initialize_google_sheets():
+    return sheets_scheduler.connect()
 
 # Product caching with automatic refresh
-PRODUCT_CACHE = None
-PRODUCT_CACHE_TIME = None
 CACHE_DURATION = 300  # 5 minutes
 
 # Static Texts
@@ -89,26 +324,181 @@ def load_txt(filename):
         with open(filename, 'r', encoding='utf-8') as f:
             return f.read().strip()
     except FileNotFoundError:
-        logger.warning(f"File {filename} not found, using default text")
+        logger.warning("File %s not found, using default text", filename)
         return ""
 
-# Load multiple details files
-greeting_text = load_txt('greeting.txt') or "Привет! Я ваш помощник по iPhone. Чем могу помочь?"
-details_texts = [
-    load_txt('details1.txt') or "У нас есть широкий выбор iPhone по отличным ценам!",
-    load_txt('details2.txt') or "Все устройства проходят тщательную проверку перед продажей.",
-    load_txt('details3.txt') or "Мы предлагаем гарантию на все устройства и бесплатную доставку."
+DEFAULT_GREETING_TEXT = "Привет! Я ваш помощник по iPhone. Чем могу помочь?"
+DEFAULT_DETAILS_TEXTS = [
+    "У нас есть широкий выбор iPhone по отличным ценам!",
+    "Все устройства проходят тщательную проверку перед продажей.",
+    "Мы предлагаем гарантию на все устройства и бесплатную доставку."
 ]
-
-delivery_options_text = load_txt('delivery_options.txt') or (
+DEFAULT_DELIVERY_OPTIONS_TEXT = (
     "Выберите способ доставки:\n"
     "1. Самовывоз\n"
     "2. Курьерская доставка"
 )
 
+# FAQ retrieval: BM25 over short passages from the static texts, used to
+# answer repeat questions without the LLM
+FAQ_FILES = [
+    'details1.txt', 'details2.txt', 'details3.txt',
+    'delivery_options.txt', 'office_closed_response.txt', 'order_form.txt'
+]
+RETRIEVAL_DIRECT_SCORE = float(os.getenv("RETRIEVAL_DIRECT_SCORE", "1.8"))
+RETRIEVAL_DIRECT_MARGIN = 1.2  # top score must beat the runner-up by this factor
+RETRIEVAL_DIRECT_MIN_TERMS = 2  # one shared word ("давайте", "подходит") is not a question match
+RETRIEVAL_PROMPT_PASSAGES = 2
+RUSSIAN_STOPWORDS = {
+    'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а', 'то',
+    'все', 'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же', 'вы', 'за',
+    'бы', 'по', 'только', 'ее', 'мне', 'было', 'вот', 'от', 'меня', 'еще',
+    'нет', 'о', 'из', 'ему', 'ли', 'если', 'уже', 'или', 'ни', 'быть', 'был',
+    'до', 'вас', 'нибудь', 'уж', 'вам', 'там', 'потом', 'себя', 'ничего',
+    'ей', 'может', 'они', 'тут', 'где', 'есть', 'надо', 'ней', 'для', 'мы',
+    'тебя', 'их', 'чем', 'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз',
+    'тоже', 'себе', 'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того',
+    'потому', 'этого', 'какой', 'совсем', 'ним', 'здесь', 'этом', 'один',
+    'почти', 'мой', 'тем', 'чтобы', 'нее', 'сейчас', 'были', 'куда', 'зачем',
+    'всех', 'никогда', 'можно', 'при', 'наконец', 'два', 'об', 'другой',
+    'хоть', 'после', 'над', 'больше', 'тот', 'через', 'эти', 'нас', 'про',
+    'всего', 'них', 'какая', 'много', 'разве', 'три', 'эту', 'моя', 'впрочем',
+    'хорошо', 'свою', 'этой', 'перед', 'иногда', 'лучше', 'чуть', 'том',
+    'нельзя', 'такой', 'им', 'более', 'всегда', 'конечно', 'всю', 'между',
+    'это', 'ваш', 'наши', 'наш', 'вообще', 'какие', 'какое', 'а', 'ну',
+    # Domain words present in almost every question
+    'телефон', 'телефоны', 'телефона', 'айфон', 'айфоны', 'айфона', 'iphone',
+    # Price words say nothing about the topic ("а сколько стоит?" may be about
+    # any phone), so they must not pull in the passage that mentions a price
+    'сколько', 'стоит', 'стоят', 'стоимость', 'стоимости', 'цена', 'цены', 'цену', 'цене'
+}
+RUSSIAN_SUFFIXES = sorted([
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой', 'ей', 'ий',
+    'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ом', 'ем', 'ах',
+    'ях', 'ов', 'ев', 'ам', 'ям', 'ия', 'ие', 'ии', 'ию', 'ть', 'ет', 'ют',
+    'ут', 'ит', 'ат', 'ят', 'ешь', 'ишь', 'ся', 'сь', 'а', 'я', 'о', 'е',
+    'ы', 'и', 'у', 'ю', 'ь'
+], key=len, reverse=True)
+RETRIEVAL_STEM_LENGTH = 5
+RETRIEVAL_SYNONYMS = {
+    'зарядка': 'зарядный', 'зарядку': 'зарядный',
+    'привезти': 'доставка', 'курьер': 'курьерская', 'забрать': 'самовывоз',
+    'сим': 'сим-картой', 'esim': 'esim', 'активация': 'активированные',
+    'новые': 'новому', 'брак': 'брака'
+}
+TOKEN_PATTERN = re.compile(r'[a-zа-яё0-9]+', re.IGNORECASE)
+
+def stem_russian(word):
+    """Light suffix-stripping stemmer, truncated to a fixed stem length"""
+    word = word.lower().replace('ё', 'е')
+    if len(word) > 4:
+        for suffix in RUSSIAN_SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                word = word[:-len(suffix)]
+                break
+    return word[:RETRIEVAL_STEM_LENGTH]
+
+def tokenize_for_retrieval(text):
+    tokens = []
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        word = RETRIEVAL_SYNONYMS.get(word, word)
+        for part in word.split('-'):
+            if part and part not in RUSSIAN_STOPWORDS:
+                tokens.append(stem_russian(part))
+    return tokens
+
+def split_into_passages(text):
+    """Split a text into passages: one per line, with list items and
+    lead-in lines (ending with ':') kept together"""
+    passages = []
+    pending_lead = ""
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        is_list_item = line[0] in '–-•' or re.match(r'^\d+\.', line)
+        if line.endswith(':'):
+            pending_lead = f"{pending_lead}\n{line}".strip()
+        elif is_list_item and passages and not pending_lead:
+            passages[-1] = f"{passages[-1]}\n{line}"
+        else:
+            passages.append(f"{pending_lead}\n{line}".strip())
+            pending_lead = ""
+    if pending_lead:
+        passages.append(pending_lead)
+    return passages
+
+class FaqIndex:
+    """BM25 index over FAQ passages"""
+    def __init__(self, passages, k1=1.5, b=0.75):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = []
+        self.doc_lengths = []
+        document_freqs = {}
+        for passage in passages:
+            tokens = tokenize_for_retrieval(passage)
+            freqs = {}
+            for token in tokens:
+                freqs[token] = freqs.get(token, 0) + 1
+            self.term_freqs.append(freqs)
+            self.doc_lengths.append(len(tokens))
+            for token in freqs:
+                document_freqs[token] = document_freqs.get(token, 0) + 1
+        doc_count = len(passages)
+        self.avg_length = (sum(self.doc_lengths) / doc_count) if doc_count else 0
+        self.idf = {
+            token: math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for token, df in document_freqs.items()
+        }
+
+    def search(self, query, top_k=3):
+        """Return [(score, passage, coverage)] sorted by descending score,
+        where coverage is the share of query terms found in the passage"""
+        query_tokens = set(tokenize_for_retrieval(query))
+        scores = []
+        for index, freqs in enumerate(self.term_freqs):
+            score = 0.0
+            matched = 0
+            length_norm = 1 - self.b + self.b * self.doc_lengths[index] / (self.avg_length or 1)
+            for token in query_tokens:
+                tf = freqs.get(token)
+                if tf:
+                    matched += 1
+                    score += self.idf[token] * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+            if score > 0:
+                scores.append((score, self.passages[index], matched / len(query_tokens)))
+        scores.sort(key=lambda x: x[0], reverse=True)
+        return scores[:top_k]
+
+def build_faq_index(texts_dir='.'):
+    passages = []
+    for filename in FAQ_FILES:
+        passages.extend(split_into_passages(load_txt(os.path.join(texts_dir, filename))))
+    logger.info("Built FAQ index with %d passages", len(passages))
+    return FaqIndex(passages)
+
+def find_direct_faq_answer(results, query):
+    """Return the top passage if it is a confident match, else None"""
+    if not results or results[0][0] < RETRIEVAL_DIRECT_SCORE or results[0][2] < 1:
+        return None
+    if len(set(tokenize_for_retrieval(query))) < RETRIEVAL_DIRECT_MIN_TERMS:
+        return None
+    if len(results) > 1 and results[0][0] < results[1][0] * RETRIEVAL_DIRECT_MARGIN:
+        return None
+    # Lead-in lines and questions to the customer are not answers
+    if results[0][1].endswith(('?', ':')):
+        return None
+    return results[0][1]
+
 # State Management
+def new_usage_totals():
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_latency": 0.0, "cost": 0.0}
+
 class UserState:
-    def __init__(self):
+    def __init__(self, store_id):
+        self.store_id = store_id
         self.phase = "init"
         self.delivery_method = None
         self.order_data = {
@@ -127,300 +517,92 @@ class UserState:
         self.current_order_step = None
         self.greeted = False
         self.order_intent_detected = False
-        self.initial_messages_sent = False  # Track if initial messages have been sent
+        self.token_usage = new_usage_totals()
 
-user_states = {}
-chat_histories = {}
 MAX_CONTEXT = 20
+SESSION_AFFINITY_WORKER = os.getenv("SESSION_AFFINITY_WORKER") == "1"
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "500"))
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "16"))
 SESSION_TIMEOUT = timedelta(minutes=45)
 
-MODEL_PATTERNS = {
-    'pro': ['pro', 'про', 'рго', 'прo', 'пpo'],
-    'max': ['max', 'макс', 'маx', 'мaкс', 'мax'],
-    'mini': ['mini', 'мини', 'минь', 'миni', 'мин'],
-    'plus': ['plus', 'плюс', 'плс', 'pls', 'плю'],
-    'standard': ['', 'стандарт', 'обычный', 'базовый']
-}
-
-MODEL_NUMBER_PATTERN = r'(?<!\d)(1[1-6]|\d{1,2})(?!\d)'
 last_request_time = 0
 AI_REQUEST_INTERVAL = 1  # 1 request per second
-request_lock = False
+request_lock = threading.Lock()
+llm_queue_depth = 0
+llm_queue_lock = threading.Lock()
 
-def is_available(availability_str):
-    if not availability_str:
-        return False
-    avail = availability_str.strip().lower()
-    return avail in ['да', 'в наличии', 'yes', 'available', 'есть']
+# Admission control: once the estimated wait in the LLM limiter passes these
+# thresholds (seconds), free-form questions are answered without the LLM
+ADMISSION_DEGRADE_WAIT = float(os.getenv("ADMISSION_DEGRADE_WAIT", "5"))
+ADMISSION_SHED_WAIT = float(os.getenv("ADMISSION_SHED_WAIT", "15"))
+ANSWER_CACHE_SIZE = 500
+answer_cache = OrderedDict()
+answer_cache_lock = threading.Lock()
 
-def cleanup_expired_sessions():
-    now = datetime.now()
-    expired_users = [
-        user_id for user_id, state in user_states.items()
-        if now - state.last_active > SESSION_TIMEOUT
-    ]
-    for user_id in expired_users:
-        del user_states[user_id]
-        if user_id in chat_histories:
-            del chat_histories[user_id]
-    logger.info(f"Cleaned up {len(expired_users)} expired sessions")
-
-def normalize_model_name(model_name):
-    if not model_name:
-        return ""
-    model = model_name.lower().translate(
-        str.maketrans('', '', string.punctuation)
-    )
-    replacements = {
-        'айфон': 'iphone',
-        'iphone': '',
-        'apple': '',
-        'series': '',
-        'model': '',
-        'gb': '',
-        'tb': '',
-        ' ': '',
-        '-': '',
-        'про': 'pro',
-        'макс': 'max',
-        'плюс': 'plus',
-        'мини': 'mini',
-        'стандарт': '',
-        'обычный': '',
-        'базовый': '',
-        'мии': 'mini',
-        'промакс': 'promax',
-        'промак': 'promax',
-        'плю': 'plus',
-        'min': 'mini',
-        'pro max': 'promax'
-    }
-    for key, value in replacements.items():
-        model = model.replace(key, value)
-    
-    model_number_match = re.search(MODEL_NUMBER_PATTERN, model)
-    model_number = model_number_match.group(0) if model_number_match else ""
-    
-    variant = ""
-    for var_type, patterns in MODEL_PATTERNS.items():
-        for pattern in patterns:
-            if pattern in model:
-                variant = var_type
-                break
-        if variant:
-            break
-    
-    # Handle special cases
-    if "promax" in model:
-        variant = "promax"
-    elif "max" in model and not variant:
-        variant = "max"
-    elif "pro" in model and not variant:
-        variant = "pro"
-    
-    return f"{model_number}{variant}"
-
-def normalize_storage(storage):
-    if not storage:
-        return ""
-    if isinstance(storage, str):
-        storage = storage.lower()
-        # Handle TB conversions
-        if 'tb' in storage or 'тб' in storage:
-            storage_num = re.sub(r'[^0-9]', '', storage)
-            if storage_num == "1024" or storage_num == "1":
-                return "1TB"
-            return f"{storage_num}TB"
-        storage_num = re.sub(r'[^0-9]', '', storage)
-        if storage_num == "1024":
-            return "1TB"
-        return f"{storage_num} ГБ" if storage_num else ""
-    return f"{storage} ГБ"
-
-def normalize_color(color):
-    if not color:
-        return ""
-    color = color.lower()
-    color_map = {
-        'space gray': 'серый',
-        'spacegrey': 'серый',
-        'spacegray': 'серый',
-        'midnight': 'синий',
-        'starlight': 'золотой',
-        'gold': 'золотой',
-        'red': 'красный',
-        'blue': 'синий',
-        'black': 'черный',
-        'white': 'белый',
-        'purple': 'фиолетовый',
-        'green': 'зеленый',
-        'silver': 'серебристый',
-        'серый': 'серый',
-        'синий': 'синий',
-        'голубой': 'синий',
-        'золотой': 'золотой',
-        'красный': 'красный',
-        'черный': 'черный',
-        'белый': 'белый',
-        'фиолетовый': 'фиолетовый',
-        'зеленый': 'зеленый',
-        'серебристый': 'серебристый',
-        'розовый': 'розовый',
-        'темная ночь': 'синий',
-        'звездный свет': 'золотой',
-        'титан': 'титан',
-        'натуральный титан': 'титан',
-        'голубой титан': 'голубой титан',
-        'белый титан': 'белый титан',
-        'чёрный титан': 'чёрный титан',
+# LLM model routing: each call site is served by a model tier, with a
+# fallback chain tried in order when a tier fails
+TOGETHER_API_URL = "https://api.together.xyz/v1/chat/completions"
+MODEL_TIERS = {
+    "small": {
+        "model": os.getenv("LLM_SMALL_MODEL", "meta-llama/Llama-3.2-3B-Instruct-Turbo"),
+        "temperature": 0.2,
+        "max_tokens": 150,
+        # USD per million prompt/completion tokens, for cost accounting
+        "prompt_price": float(os.getenv("LLM_SMALL_PROMPT_PRICE", "0.06")),
+        "completion_price": float(os.getenv("LLM_SMALL_COMPLETION_PRICE", "0.06"))
+    },
+    "large": {
+        "model": os.getenv("LLM_LARGE_MODEL", "deepseek-ai/DeepSeek-R1-Distill-Llama-70B-free"),
+        "temperature": 0.4,
+        "max_tokens": 300,
+        "prompt_price": float(os.getenv("LLM_LARGE_PROMPT_PRICE", "0")),
+        "completion_price": float(os.getenv("LLM_LARGE_COMPLETION_PRICE", "0"))
     }
-    if color in color_map:
-        return color_map[color]
-    best_match = None
-    best_score = 0
-    for key in color_map:
-        score = jellyfish.jaro_similarity(color, key)
-        if score > 0.85 and score > best_score:
-            best_match = key
-            best_score = score
-    return color_map[best_match] if best_match else color
-
-def find_matching_products(products, model=None, storage=None, color=None):
-    results = []
-    for product in products:
-        if not is_available(product.get('Наличие', '')):
-            continue
-        match_score = 0
-        if model:
-            input_norm = normalize_model_name(model)
-            product_norm = normalize_model_name(product.get('Модель', ''))
-            if input_norm == product_norm:
-                match_score += 100
-            elif input_norm in product_norm or product_norm in input_norm:
-                match_score += 75
-            else:
-                input_nums = set(re.findall(r'\d+', input_norm))
-                product_nums = set(re.findall(r'\d+', product_norm))
-                if input_nums and input_nums.issubset(product_nums):
-                    match_score += 50
-                elif input_nums and product_nums and input_nums == product_nums:
-                    match_score += 40
-        if storage:
-            input_norm = normalize_storage(storage)
-            product_norm = normalize_storage(product.get('Объём', ''))
-            if input_norm == product_norm:
-                match_score += 20
-        if color:
-            input_norm = normalize_color(color)
-            product_norm = normalize_color(product.get('Цвет', ''))
-            if input_norm == product_norm:
-                match_score += 10
-        if (model or storage or color) and match_score >= 50:
-            results.append((product, match_score))
-    results.sort(key=lambda x: x[1], reverse=True)
-    return [item[0] for item in results]
-
-def get_available_products():
-    global PRODUCT_CACHE, PRODUCT_CACHE_TIME
-    # Return cached data if recent
-    now = datetime.now()
-    if (PRODUCT_CACHE and PRODUCT_CACHE_TIME and 
-        (now - PRODUCT_CACHE_TIME).seconds < CACHE_DURATION):
-        return PRODUCT_CACHE
-    
-    try:
-        products = product_sheet.get_all_records()
-        # Convert 1024 GB to 1TB and handle other storage formats
-        for product in products:
-            storage = product.get('Объём', '')
-            normalized = normalize_storage(storage)
-            if normalized != storage:
-                product['Объём'] = normalized
-        PRODUCT_CACHE = products
-        PRODUCT_CACHE_TIME = now
-        logger.info(f"Loaded {len(products)} products from Google Sheets")
-        if products:
-            logger.info(f"Sample product: {products[0]}")
-        return products
-    except Exception as e:
-        logger.error(f"Product fetch error: {str(e)}")
-        # Try to reinitialize connection
-        if "RESOURCE_EXHAUSTED" in str(e) or "UNAUTHENTICATED" in str(e):
-            logger.warning("Reinitializing Google Sheets connection")
-            initialize_google_sheets()
-        return PRODUCT_CACHE or []  # Return stale cache if available
-
-def get_available_models(products=None):
-    if products is None:
-        products = get_available_products()
-    return list(set(
-        p['Модель'] for p in products if is_available(p.get('Наличие', ''))
-    ))
+}
+# Call sites pinned to a tier; anything else is routed by prompt size
+CALL_SITE_TIERS = {
+    "classify_order_intent": "small",
+    "handle_product_info_response": "large"
+}
+SMALL_PROMPT_MAX_CHARS = int(os.getenv("LLM_SMALL_PROMPT_MAX_CHARS", "1200"))
+MODEL_FALLBACK_CHAINS = {
+    "small": os.getenv("LLM_SMALL_FALLBACK", "small,large").split(","),
+    "large": os.getenv("LLM_LARGE_FALLBACK", "large,small").split(",")
+}
+# Call sites with their own chain. The intent classifier asks for a one-word
+# answer in 10 tokens, which the large reasoning model spends on <think>
+CALL_SITE_FALLBACKS = {
+    "classify_order_intent": ["small"]
+}
+tier_stats = {
+    tier: {"calls": 0, "errors": 0, "total_latency": 0.0}
+    for tier in MODEL_TIERS
+}
+tier_stats_lock = threading.Lock()
+LLM_HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", "16"))
+llm_http = None  # per-process requests.Session, created by init_worker()
+# Token usage from the API's `usage` block, aggregated per call site and per
+# model; per-session totals live on UserState
+usage_stats = {"call_sites": {}, "models": {}}
+usage_stats_lock = threading.Lock()
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))  # 0 = unlimited
 
-def get_available_storages(products, model):
-    return list(set(
-        p['Объём'] for p in products
-        if is_available(p.get('Наличие', '')) and
-        normalize_model_name(p.get('Модель', '')) == normalize_model_name(model)
-    ))
+def cleanup_expired_sessions():
+    expired_count = 0
+    for store in store_registry.loaded():
+        expired_count += store.cleanup_expired_sessions()
+    # Stores left without sessions can now be evicted
+    store_registry.evict_idle()
+    logger.info("Cleaned up %d expired sessions", expired_count,
+                extra={"log_category": "session_cleanup"})
 
-def get_available_colors(products, model, storage):
+def get_available_models(products):
+    if isinstance(products, ColumnarCatalog):
+        return products.distinct('model', products.filter())
     return list(set(
-        p['Цвет'] for p in products
-        if is_available(p.get('Наличие', '')) and
-        normalize_model_name(p.get('Модель', '')) == normalize_model_name(model) and
-        normalize_storage(p.get('Объём', '')) == normalize_storage(storage)
+        p['Модель'] for p in products if is_available(p.get('Наличие', ''))
     ))
 
-def find_similar_models(user_input, available_models):
-    user_input_norm = normalize_model_name(user_input)
-    suggestions = []
-    seen = set()
-    for model in available_models:
-        norm_model = normalize_model_name(model)
-        if user_input_norm in norm_model or norm_model in user_input_norm:
-            if model not in seen:
-                suggestions.append(model)
-                seen.add(model)
-    if not suggestions:
-        numbers = re.findall(r'\d+', user_input)
-        if numbers:
-            for model in available_models:
-                model_numbers = re.findall(r'\d+', model)
-                if any(num in model_numbers for num in numbers):
-                    if model not in seen:
-                        suggestions.append(model)
-                        seen.add(model)
-    if not suggestions:
-        for model in available_models:
-            norm_model = normalize_model_name(model)
-            match = True
-            for keyword, patterns in MODEL_PATTERNS.items():
-                if keyword in norm_model:
-                    if not any(pattern in user_input_norm for pattern in patterns):
-                        match = False
-                        break
-            if match and model not in seen:
-                suggestions.append(model)
-                seen.add(model)
-    if not suggestions:
-        similarity_scores = []
-        for model in available_models:
-            norm_model = normalize_model_name(model)
-            similarity = jellyfish.jaro_similarity(user_input_norm, norm_model)
-            if similarity > 0.85:
-                similarity_scores.append((model, similarity))
-        similarity_scores.sort(key=lambda x: x[1], reverse=True)
-        suggestions = [item[0] for item in similarity_scores]
-    if not suggestions:
-        suggestions = difflib.get_close_matches(
-            user_input,
-            available_models,
-            n=3,
-            cutoff=0.7
-        )
-    return suggestions[:3]
-
 def format_order_summary(order_data):
     summary = "📝 <b>Ваш заказ:</b>\n"
     summary += f"• <b>Модель:</b> {order_data['Модель']}\n"
@@ -432,36 +614,6 @@ def format_order_summary(order_data):
     summary += f"• <b>Контакт:</b> {order_data['Контакт']}"
     return summary
 
-def extract_models_from_input(user_input):
-    models = []
-    patterns = [
-        r'\b(?:iphone|айфон|phone)\s*(\d{1,2})\s*(pro\s*max|pro|plus|mini|max)?\b',
-        r'\b(\d{1,2})\s*(pro\s*max|pro|plus|mini|max|мини|мин|мии|про|плюс)\b',
-        r'\b(?:iphone|айфон)\s*(\d{1,2})\b',
-        r'\b(?:айфон|айфона|айфоном)\s*(\d{1,2})\s*(про|макс|мини|плюс)?\b',
-        r'\b(?:iphone|айфон)(\d{1,2})\s*(pro\s*max|pro|plus|mini|max)?\b'
-    ]
-    for pattern in patterns:
-        matches = re.findall(pattern, user_input, re.IGNORECASE)
-        for match in matches:
-            if isinstance(match, tuple):
-                number = match[0]
-                variant = match[1] if len(match) > 1 else ""
-            else:
-                number = match
-                variant = ""
-            variant_map = {
-                'мин': 'mini', 'мини': 'mini', 'мии': 'mini',
-                'про': 'pro', 'плюс': 'plus', 'макс': 'max'
-            }
-            variant = variant_map.get(variant.lower(), variant.lower())
-            model_name = f"iPhone {number}"
-            if variant:
-                model_name += f" {variant.capitalize()}"
-            models.append(model_name)
-    seen = set()
-    return [m for m in models if not (m in seen or seen.add(m))]
-
 def match_delivery_option(text):
     text = text.lower()
     if "самовывоз" in text or "офис" in text or "заберу" in text:
@@ -470,26 +622,619 @@ def match_delivery_option(text):
         return "Курьерская доставка"
     return None
 
-def submit_order(data):
+YES_ANSWERS = ("да", "yes", "д")
+NO_ANSWERS = ("нет", "no", "н")
+DECLINE_WORDS = ("нет", "не надо")
+
+class MessageAnalysis:
+    """Parsed view of one user message, shared by all phase handlers.
+
+    Each attribute is computed on first access and cached, so a turn pays
+    only for the analysis its handlers actually use, and never twice.
+    """
+    def __init__(self, text):
+        self.text = text
+
+    @cached_property
+    def lower(self):
+        return self.text.lower()
+
+    @cached_property
+    def answer(self):
+        """'yes' or 'no' for a bare Да/Нет reply, else None"""
+        if self.lower in YES_ANSWERS:
+            return "yes"
+        if self.lower in NO_ANSWERS:
+            return "no"
+        return None
+
+    @property
+    def is_yes(self):
+        return self.answer == "yes"
+
+    @property
+    def is_no(self):
+        return self.answer == "no"
+
+    @cached_property
+    def declines(self):
+        return self.contains_any(DECLINE_WORDS)
+
+    @cached_property
+    def models(self):
+        return extract_models_from_input(self.text)
+
+    @cached_property
+    def storage(self):
+        return normalize_storage(self.text)
+
+    @cached_property
+    def color(self):
+        return normalize_color(self.text)
+
+    @cached_property
+    def delivery(self):
+        return match_delivery_option(self.lower)
+
+    def contains_any(self, words):
+        return any(word in self.lower for word in words)
+
+# Local mirror of the order sheet for lookups and duplicate detection
+ORDER_MIRROR_PATH = os.getenv("ORDER_MIRROR_PATH", "orders.db")
+ORDER_RECONCILE_INTERVAL = int(os.getenv("ORDER_RECONCILE_INTERVAL", "600"))  # seconds
+DUPLICATE_ORDER_WINDOW = timedelta(hours=int(os.getenv("DUPLICATE_ORDER_WINDOW_HOURS", "72")))
+ORDER_COLUMNS = ["ФИО", "Контакт", "Модель", "Объём", "Цвет", "Зарядный блок", "Доставка"]
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+def normalize_contact(contact):
+    """Canonical form of a phone number or Telegram username"""
+    if not contact:
+        return ""
+    contact = contact.strip().lower()
+    phone_match = re.match(r'^(\+7|7|8)?(\d{10})$', re.sub(r'[\s()-]', '', contact))
+    if phone_match:
+        return "+7" + phone_match.group(2)
+    return contact if contact.startswith("@") else "@" + contact
+
+BACKFILL_CREATED_AT = datetime(1970, 1, 1)  # orders first seen in the sheet, date unknown
+
+class OrderMirror:
+    """SQLite copy of the order sheet, fed by the app's own writes and by
+    periodic reconciliation against the sheet.
+
+    Rows written by the app get their sheet row number from the append
+    response; reconciliation matches rows by content, so rows deleted or
+    moved in the sheet are dropped or renumbered, and adds rows entered
+    elsewhere. The sheet has no date column, so backfilled rows get
+    BACKFILL_CREATED_AT and never count as recent orders.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sheet_row INTEGER UNIQUE,
+                    full_name TEXT,
+                    contact TEXT,
+                    model TEXT,
+                    model_key TEXT,
+                    storage TEXT,
+                    color TEXT,
+                    charger TEXT,
+                    delivery TEXT,
+                    created_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_orders_contact ON orders (contact);
+                CREATE INDEX IF NOT EXISTS idx_orders_model ON orders (model_key);
+                CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
+                CREATE TABLE IF NOT EXISTS mirror_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+
+    def record(self, row, sheet_row=None, created_at=None):
+        with self.lock, self.connection:
+            if sheet_row is not None:
+                # The append landed on this row number, so whatever the mirror
+                # had there was deleted or moved in the sheet; reconciliation
+                # matches it again by content
+                self.connection.execute(
+                    "UPDATE orders SET sheet_row = NULL WHERE sheet_row = ?", (sheet_row,)
+                )
+            self.insert(row, sheet_row, created_at or datetime.now())
+
+    def insert(self, row, sheet_row, created_at):
+        values = list(row) + [""] * (len(ORDER_COLUMNS) - len(row))
+        self.connection.execute(
+            """INSERT INTO orders
+               (sheet_row, full_name, contact, model, model_key, storage, color, charger, delivery, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [sheet_row, values[0], normalize_contact(values[1]), values[2],
+             normalize_model_name(values[2])] + values[3:7] + [created_at.isoformat(timespec="seconds")]
+        )
+
+    @staticmethod
+    def content_key(full_name, contact, model, storage, color, charger, delivery):
+        return (full_name, normalize_contact(contact), model, storage, color, charger, delivery)
+
+    def reconcile(self, sheet_rows, read_at=None):
+        """Sync from the full sheet contents (header row first), read starting
+        at `read_at`; returns the number of rows added"""
+        sheet_entries = []
+        for row_number, row in enumerate(sheet_rows[1:], start=2):
+            if not any(row):
+                continue
+            values = [str(value) for value in row[:len(ORDER_COLUMNS)]]
+            values += [""] * (len(ORDER_COLUMNS) - len(values))
+            sheet_entries.append((row_number, values))
+        with self.lock, self.connection:
+            # Mirror rows by content; rows already at the right number first
+            mirrored = {}
+            for order_id, sheet_row, created_at, *content in self.connection.execute(
+                """SELECT id, sheet_row, created_at, full_name, contact, model, storage, color, charger, delivery
+                   FROM orders ORDER BY sheet_row IS NULL, id"""
+            ):
+                mirrored.setdefault(self.content_key(*content), []).append((order_id, sheet_row, created_at))
+            matched = []
+            added_rows = []
+            for row_number, values in sheet_entries:
+                candidates = mirrored.get(self.content_key(*values))
+                if not candidates:
+                    added_rows.append((row_number, values))
+                    continue
+                index = next(
+                    (i for i, (_, sheet_row, _) in enumerate(candidates) if sheet_row == row_number), 0
+                )
+                matched.append((candidates.pop(index)[0], row_number))
+            # Rows seen in the sheet before but gone now were deleted there.
+            # Rows without a number are gone too if recorded before the read
+            # started; newer app writes may not be visible yet.
+            visible_before = read_at.isoformat(timespec="seconds") if read_at else ""
+            removed = [
+                order_id for candidates in mirrored.values()
+                for order_id, sheet_row, created_at in candidates
+                if sheet_row is not None or created_at < visible_before
+            ]
+            self.connection.executemany("DELETE FROM orders WHERE id = ?", [(i,) for i in removed])
+            # Renumber in two steps so the UNIQUE sheet_row never collides
+            self.connection.executemany(
+                "UPDATE orders SET sheet_row = NULL WHERE id = ?", [(i,) for i, _ in matched]
+            )
+            self.connection.executemany(
+                "UPDATE orders SET sheet_row = ? WHERE id = ?", [(n, i) for i, n in matched]
+            )
+            for row_number, values in added_rows:
+                self.insert(values, row_number, BACKFILL_CREATED_AT)
+        return len(added_rows)
+
+    def claim_reconcile(self, interval):
+        """True if this process should reconcile now. Workers sharing the
+        database file take turns instead of each reading the full sheet."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO mirror_state (key, value) VALUES ('last_reconcile', '0')"
+            )
+            return self.connection.execute(
+                """UPDATE mirror_state SET value = ?
+                   WHERE key = 'last_reconcile' AND CAST(value AS REAL) <= ?""",
+                (str(now), now - interval)
+            ).rowcount == 1
+
+    def find_orders(self, contact=None, model=None, since=None, limit=20):
+        """Most recent orders matching all given filters"""
+        conditions = []
+        params = []
+        if contact:
+            conditions.append("contact = ?")
+            params.append(normalize_contact(contact))
+        if model:
+            conditions.append("model_key = ?")
+            params.append(normalize_model_name(model))
+        if since:
+            conditions.append("created_at >= ?")
+            params.append(since.isoformat(timespec="seconds"))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            cursor = self.connection.execute(
+                f"""SELECT sheet_row, full_name, contact, model, storage, color,
+                           charger, delivery, created_at
+                    FROM orders {where} ORDER BY created_at DESC, id DESC LIMIT ?""",
+                params + [limit]
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def parse_appended_row(append_response):
+    """Row number from an append response's updatedRange, e.g. 'Sheet1!A5:G5'"""
     try:
-        order_sheet.append_row([
-            data["ФИО"],
-            data["Контакт"],
-            data["Модель"],
-            data["Объём"],
-            data["Цвет"],
-            data["Зарядный блок"],
-            data["Доставка"]
-        ], value_input_option='USER_ENTERED')
-        logger.info(f"Order submitted: {data}")
-        return True
+        updated_range = append_response["updates"]["updatedRange"]
+        return int(re.search(r'![A-Z]+(\d+)', updated_range).group(1))
+    except (TypeError, KeyError, AttributeError, ValueError):
+        return None
+
+# Multi-store support: every store has its own product and order sheets,
+# texts, catalog cache, order mirror and session namespace. Stores are
+# loaded on first use and idle ones are evicted least recently used first.
+DEFAULT_STORE_ID = "default"
+DEFAULT_STORE_NAME = os.getenv("STORE_NAME", "WAY PHONE")
+DEFAULT_CHARGER_PRICE = os.getenv("CHARGER_PRICE", "2500")
+MAX_LOADED_STORES = int(os.getenv("MAX_LOADED_STORES", "20"))
+STORE_ID_PATTERN = re.compile(r'^[a-z0-9_-]{1,64}$')
+
+def load_store_configs():
+    """Store configs keyed by store id.
+
+    The default store comes from PRODUCT_SHEET_URL/ORDER_SHEET_URL and the
+    texts next to app.py. STORES_CONFIG (JSON, or a path to a JSON file) adds
+    stores as {"store_id": {"product_sheet_url": ..., "order_sheet_url": ...,
+    "texts_dir": ..., "order_mirror_path": ..., "name": ..., "charger_price": ...}}.
+    "name" is how the assistant presents the shop.
+    """
+    configs = {
+        DEFAULT_STORE_ID: {
+            "product_sheet_url": PRODUCT_SHEET_URL,
+            "order_sheet_url": ORDER_SHEET_URL,
+            "texts_dir": ".",
+            "order_mirror_path": ORDER_MIRROR_PATH,
+            "name": DEFAULT_STORE_NAME,
+            "charger_price": DEFAULT_CHARGER_PRICE
+        }
+    }
+    raw_config = os.getenv("STORES_CONFIG")
+    if not raw_config:
+        return configs
+    if not raw_config.lstrip().startswith("{"):
+        with open(raw_config, 'r', encoding='utf-8') as f:
+            raw_config = f.read()
+    for store_id, config in json.loads(raw_config).items():
+        if not STORE_ID_PATTERN.match(store_id):
+            raise ValueError(f"Invalid store id: {store_id!r}")
+        if not config.get("product_sheet_url") or not config.get("order_sheet_url"):
+            raise ValueError(f"Store {store_id!r} needs product_sheet_url and order_sheet_url")
+        configs[store_id] = {
+            "texts_dir": ".",
+            "order_mirror_path": f"orders_{store_id}.db",
+            "name": store_id,
+            "charger_price": DEFAULT_CHARGER_PRICE,
+            **config
+        }
+    return configs
+
+class Store:
+    """One storefront: sheets, texts, catalog cache, order mirror and sessions"""
+    def __init__(self, store_id, config):
+        self.store_id = store_id
+        self.config = config
+        self.name = config["name"]
+        self.charger_price = config["charger_price"]
+        self.user_states = {}
+        self.chat_histories = {}
+        self.product_sheet = None
+        self.order_sheet = None
+        self.sheets_generation = None
+        self.product_cache = None
+        self.product_cache_time = None
+        self.catalog = ColumnarCatalog([])
+        self.cache_warm_thread = None
+        self.cache_warm_lock = threading.Lock()
+        self.load_texts()
+
+    @cached_property
+    def order_mirror(self):
+        # Opened on first use, so a store preloaded in the gunicorn master
+        # gets its SQLite connection in the worker, after fork
+        return OrderMirror(self.config["order_mirror_path"])
+
+    def load_texts(self):
+        texts_dir = self.config["texts_dir"]
+        self.greeting_text = load_txt(os.path.join(texts_dir, 'greeting.txt')) or DEFAULT_GREETING_TEXT
+        self.details_texts = tuple(
+            load_txt(os.path.join(texts_dir, filename)) or default_text
+            for filename, default_text in zip(
+                ['details1.txt', 'details2.txt', 'details3.txt'], DEFAULT_DETAILS_TEXTS
+            )
+        )
+        self.delivery_options_text = (
+            load_txt(os.path.join(texts_dir, 'delivery_options.txt')) or DEFAULT_DELIVERY_OPTIONS_TEXT
+        )
+        # Initial message bundle returned by /start_chat, prepared once at load time
+        self.initial_messages = (self.greeting_text,) + self.details_texts
+        self.faq_index = build_faq_index(texts_dir)
+
+    def open_sheets(self, scheduler):
+        """Open this store's sheets with the scheduler's current client.
+        Runs inside scheduled operations."""
+        if self.sheets_generation != scheduler.generation:
+            # Opening the two sheets costs two requests of their own
+            scheduler.wait_for_quota(2)
+            # Open by URL with error handling
+            self.product_sheet = scheduler.gc.open_by_url(self.config["product_sheet_url"]).sheet1
+            self.order_sheet = scheduler.gc.open_by_url(self.config["order_sheet_url"]).sheet1
+            self.sheets_generation = scheduler.generation
+
+    def release_sheets(self):
+        """Drop sheet handles (and the client sockets behind them)"""
+        self.product_sheet = None
+        self.order_sheet = None
+        self.sheets_generation = None
+
+    def read_products(self, scheduler):
+        self.open_sheets(scheduler)
+        return self.product_sheet.get_all_records()
+
+    def read_orders(self, scheduler):
+        self.open_sheets(scheduler)
+        return self.order_sheet.get_all_values()
+
+    def append_order(self, scheduler, row):
+        self.open_sheets(scheduler)
+        return self.order_sheet.append_row(row, value_input_option='USER_ENTERED')
+
+    def cache_is_fresh(self):
+        return bool(
+            self.product_cache and self.product_cache_time and
+            (datetime.now() - self.product_cache_time).seconds < CACHE_DURATION
+        )
+
+    def get_available_products(self):
+        # Return cached data if recent
+        if self.cache_is_fresh():
+            return self.product_cache
+        if self.product_cache:
+            # Keep serving the old catalog while the new one is read and indexed
+            self.warm_product_cache_async()
+            return self.product_cache
+        return self.refresh_products()
+
+    def refresh_products(self):
+        try:
+            products = sheets_scheduler.read(
+                f"catalog:{self.store_id}", self.read_products
+            ).result(timeout=SHEETS_REQUEST_TIMEOUT)
+            return self.set_products(products)
+        except Exception as e:
+            logger.error("Product fetch error for store %s: %s", self.store_id, e)
+            return self.product_cache or []  # Return stale cache if available
+
+    def set_products(self, products):
+        # Convert 1024 GB to 1TB and handle other storage formats
+        for product in products:
+            storage = product.get('Объём', '')
+            normalized = normalize_storage(storage)
+            if normalized != storage:
+                product['Объём'] = normalized
+        # Index before publishing so the cache and the catalog swap together
+        catalog = ColumnarCatalog(products)
+        self.product_cache, self.catalog = products, catalog
+        self.product_cache_time = datetime.now()
+        logger.info("Loaded %d products for store %s", len(products), self.store_id)
+        if products:
+            logger.info("Sample product: %s", products[0], extra={"log_category": "catalog_sample"})
+        return products
+
+    def get_catalog_store(self):
+        """Columnar view of the current product cache"""
+        self.get_available_products()
+        return self.catalog
+
+    def warm_product_cache_async(self):
+        """Refresh the product cache in a background thread if it is stale"""
+        if self.cache_is_fresh():
+            return
+        with self.cache_warm_lock:
+            if self.cache_warm_thread and self.cache_warm_thread.is_alive():
+                return
+            self.cache_warm_thread = threading.Thread(
+                target=self.refresh_products,
+                name=f"product-cache-warmer-{self.store_id}",
+                daemon=True
+            )
+            self.cache_warm_thread.start()
+
+    def start_session(self, session_id):
+        user_state = UserState(self.store_id)
+        self.user_states[session_id] = user_state
+        self.chat_histories[session_id] = [
+            {"role": "assistant", "content": msg} for msg in self.initial_messages
+        ]
+
+    def cleanup_expired_sessions(self):
+        now = datetime.now()
+        expired_users = [
+            user_id for user_id, state in list(self.user_states.items())
+            if now - state.last_active > SESSION_TIMEOUT
+        ]
+        for user_id in expired_users:
+            self.user_states.pop(user_id, None)
+            self.chat_histories.pop(user_id, None)
+        return len(expired_users)
+
+    def is_idle(self):
+        return not self.user_states
+
+    def close(self):
+        if 'order_mirror' in self.__dict__:
+            with self.order_mirror.lock:
+                self.order_mirror.connection.close()
+
+class StoreRegistry:
+    """Loaded stores in least-recently-used order"""
+    def __init__(self, configs, max_loaded):
+        self.configs = configs
+        self.max_loaded = max_loaded
+        self.stores = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, store_id, load=True):
+        """Return a store, loading it on first use; None for unknown ids
+        (or for stores not loaded yet when load=False)"""
+        with self.lock:
+            store = self.get_locked(store_id, load)
+        self.evict_idle()
+        return store
+
+    def start_session(self, store_id, session_id):
+        """Return the store with a new session added, or None for unknown ids.
+        The session is added under the registry lock, so the store cannot be
+        evicted as idle between loading it and attaching the session."""
+        with self.lock:
+            store = self.get_locked(store_id, True)
+            if store is not None:
+                store.start_session(session_id)
+        self.evict_idle()
+        return store
+
+    def get_locked(self, store_id, load):
+        store = self.stores.get(store_id)
+        if store is None:
+            if not load or store_id not in self.configs:
+                return None
+            store = Store(store_id, self.configs[store_id])
+            self.stores[store_id] = store
+            logger.info("Loaded store %s", store_id)
+        self.stores.move_to_end(store_id)
+        return store
+
+    def evict_idle(self):
+        """Evict idle stores, oldest first, until within max_loaded. The most
+        recently used store is kept: the caller that loaded it is still using it."""
+        with self.lock:
+            for store_id in list(self.stores)[:-1]:
+                if len(self.stores) <= self.max_loaded:
+                    break
+                store = self.stores[store_id]
+                if store.is_idle():
+                    del self.stores[store_id]
+                    store.close()
+                    logger.info("Evicted idle store %s", store_id)
+
+    def loaded(self):
+        with self.lock:
+            return list(self.stores.values())
+
+store_registry = StoreRegistry(load_store_configs(), MAX_LOADED_STORES)
+
+def make_session_id(store_id):
+    """Session ids carry their store, so any request can be routed to it"""
+    return f"{store_id}:{uuid.uuid4()}"
+
+def get_session(session_id):
+    """Return (store, user_state) for a session id, or (None, None)"""
+    if not isinstance(session_id, str) or ":" not in session_id:
+        return None, None
+    store = store_registry.get(session_id.split(":", 1)[0], load=False)
+    user_state = store.user_states.get(session_id) if store else None
+    if user_state is None:
+        return None, None
+    return store, user_state
+
+def reconcile_order_mirror(store):
+    try:
+        if not store.order_mirror.claim_reconcile(ORDER_RECONCILE_INTERVAL):
+            return
+        read_at = datetime.now()
+        sheet_rows = sheets_scheduler.read(
+            f"orders:{store.store_id}", store.read_orders
+        ).result(timeout=SHEETS_REQUEST_TIMEOUT)
+        added = store.order_mirror.reconcile(sheet_rows, read_at)
+        logger.info("Order mirror for store %s reconciled, %d new rows", store.store_id, added)
     except Exception as e:
-        logger.error(f"Order submission error: {str(e)}")
-        # Try to reinitialize connection
-        if "RESOURCE_EXHAUSTED" in str(e) or "UNAUTHENTICATED" in str(e):
-            logger.warning("Reinitializing Google Sheets connection")
-            initialize_google_sheets()
-        return False
+        logger.error("Order mirror reconciliation error for store %s: %s", store.store_id, e)
+
+def run_order_reconciliation():
+    while True:
+        for store in store_registry.loaded():
+            reconcile_order_mirror(store)
+        time.sleep(ORDER_RECONCILE_INTERVAL)
+
+def find_duplicate_order(store, order_data):
+    """Recent mirrored order for the same contact and model, if any"""
+    orders = store.order_mirror.find_orders(
+        contact=order_data.get("Контакт"),
+        model=order_data.get("Модель"),
+        since=datetime.now() - DUPLICATE_ORDER_WINDOW,
+        limit=1
+    )
+    return orders[0] if orders else None
+
+def format_order_status(orders):
+    lines = ["📦 <b>Ваши заказы:</b>"]
+    for order in orders:
+        created_at = datetime.fromisoformat(order["created_at"])
+        created = "" if created_at == BACKFILL_CREATED_AT else f"{created_at.strftime('%d.%m.%Y')}: "
+        lines.append(
+            f"• {created}{order['model']} {order['storage']} {order['color']} — заявка принята"
+        )
+    lines.append("Менеджер свяжется с вами для уточнения деталей.")
+    return "\n".join(lines)
+
+ORDER_STATUS_MANAGER_REPLY = (
+    "Статус заказа подскажет менеджер — он свяжется с вами по контакту, "
+    "указанному при оформлении. Чем ещё могу помочь?"
+)
+ORDER_STATUS_KEYWORDS = ["мой заказ", "моего заказа", "моему заказу", "статус заказа", "где заказ", "заказ оформлен", "я заказывал", "я заказывала", "уже заказ"]
+
+def handle_order_status_question(message, user_state, store):
+    """Answer 'what about my order' questions from the local mirror.
+    Returns None if the message is not a status question.
+
+    Only orders for the contact given in this session are shown; a contact
+    typed into the chat is not proof of identity, so those go to a manager."""
+    if not message.contains_any(ORDER_STATUS_KEYWORDS):
+        return None
+    contact = user_state.order_data.get("Контакт")
+    if not contact:
+        return ORDER_STATUS_MANAGER_REPLY
+    orders = store.order_mirror.find_orders(contact=contact, limit=5)
+    if not orders:
+        return "Не нашёл заказов на этот контакт. Хотите оформить новый заказ?"
+    return format_order_status(orders)
+
+ORDER_SUBMITTED = "submitted"
+ORDER_PENDING = "pending"  # the append is running and will finish in the background
+ORDER_FAILED = "failed"
+
+def record_submitted_order(store, row, append_future):
+    """Mirror an order once its sheet append has finished"""
+    try:
+        append_response = append_future.result()
+        logger.info("Order submitted to store %s: %s", store.store_id, row)
+    except Exception as e:
+        logger.error("Order submission error: %s", e)
+        return
+    try:
+        store.order_mirror.record(row, sheet_row=parse_appended_row(append_response))
+    except Exception as e:
+        logger.error("Order mirror write error: %s", e)
+
+def submit_order(store, data):
+    """Append an order to the sheet; returns ORDER_SUBMITTED, ORDER_PENDING
+    or ORDER_FAILED.
+
+    A write still queued at the timeout is cancelled, so a retry cannot
+    append the order twice. One that already started is left to finish and
+    reported as pending rather than failed for the same reason."""
+    row = [data[column] for column in ORDER_COLUMNS]
+    append_future = sheets_scheduler.write(
+        lambda scheduler: store.append_order(scheduler, row)
+    )
+    done, _ = wait([append_future], timeout=SHEETS_REQUEST_TIMEOUT)
+    if not done:
+        if append_future.cancel():
+            logger.error("Order submission timed out in the queue, cancelled: %s", row)
+            return ORDER_FAILED
+        logger.warning("Order submission still running after %ss: %s", SHEETS_REQUEST_TIMEOUT, row)
+        append_future.add_done_callback(
+            lambda future: record_submitted_order(store, row, future)
+        )
+        return ORDER_PENDING
+    record_submitted_order(store, row, append_future)
+    return ORDER_FAILED if append_future.exception() else ORDER_SUBMITTED
 
 def clean_ai_response(text):
     """Remove internal thinking tags and prefixes from AI responses"""
@@ -510,37 +1255,246 @@ def clean_ai_response(text):
 
 def rate_limited_request():
     """Ensure minimum interval between AI requests"""
-    global last_request_time, request_lock
-    
-    while request_lock:
-        time.sleep(0.1)
-    
-    request_lock = True
-    current_time = time.time()
-    elapsed = current_time - last_request_time
+    global last_request_time, llm_queue_depth
     
-    if elapsed < AI_REQUEST_INTERVAL:
-        time.sleep(AI_REQUEST_INTERVAL - elapsed)
-        
-    last_request_time = time.time()
-    request_lock = False
+    with llm_queue_lock:
+        llm_queue_depth += 1
+    try:
+        with request_lock:
+            current_time = time.time()
+            elapsed = current_time - last_request_time
+            
+            if elapsed < AI_REQUEST_INTERVAL:
+                time.sleep(AI_REQUEST_INTERVAL - elapsed)
+                
+            last_request_time = time.time()
+    finally:
+        with llm_queue_lock:
+            llm_queue_depth -= 1
+
+def estimate_llm_wait():
+    """Estimated seconds a new AI request would wait in the limiter"""
+    with llm_queue_lock:
+        depth = llm_queue_depth
+    return depth * AI_REQUEST_INTERVAL
+
+def get_admission_level(user_state=None):
+    """Return 'normal', 'degraded' or 'overloaded' based on the LLM backlog.
+    A session that used up its token budget gets at most 'degraded'."""
+    estimated_wait = estimate_llm_wait()
+    if estimated_wait >= ADMISSION_SHED_WAIT:
+        return "overloaded"
+    if estimated_wait >= ADMISSION_DEGRADE_WAIT:
+        return "degraded"
+    if user_state is not None and session_over_budget(user_state):
+        return "degraded"
+    return "normal"
+
+def get_admission_stats():
+    with llm_queue_lock:
+        depth = llm_queue_depth
+    return {
+        "queue_depth": depth,
+        "estimated_wait": depth * AI_REQUEST_INTERVAL,
+        "level": get_admission_level()
+    }
+
+LLM_HTTP_ERROR_REPLY = "Извините, временные технические трудности. Попробуйте позже."
+LLM_FAILED_REPLY = "Извините, не могу обработать запрос. Попробуйте позже."
+LLM_UNAVAILABLE_REPLY = "Извините, сервис временно недоступен. Попробуйте через несколько минут."
+LLM_ERROR_REPLIES = (LLM_HTTP_ERROR_REPLY, LLM_FAILED_REPLY, LLM_UNAVAILABLE_REPLY)
+
+def is_cacheable_question(message):
+    """Only questions that name a model are cached: 'А какой цвет?' depends
+    on what was discussed before and must not get another user's answer.
+    (Self-contained FAQ questions are answered by retrieval before this.)"""
+    return bool(message.models)
+
+def answer_cache_key(store_id, user_input):
+    normalized = " ".join(user_input.lower().translate(
+        str.maketrans('', '', string.punctuation)
+    ).split())
+    # Stores have different catalogs and texts, so answers are per store
+    return f"{store_id}:{normalized}" if normalized else ""
+
+def get_cached_answer(store_id, user_input):
+    key = answer_cache_key(store_id, user_input)
+    with answer_cache_lock:
+        answer = answer_cache.get(key)
+        if answer is not None:
+            answer_cache.move_to_end(key)
+        return answer
+
+def cache_answer(store_id, user_input, answer):
+    key = answer_cache_key(store_id, user_input)
+    if not key or answer in LLM_ERROR_REPLIES:
+        return
+    with answer_cache_lock:
+        answer_cache[key] = answer
+        answer_cache.move_to_end(key)
+        while len(answer_cache) > ANSWER_CACHE_SIZE:
+            answer_cache.popitem(last=False)
+
+OVERLOADED_REPLY = (
+    "Сейчас у нас очень много обращений 🙏 "
+    "Мы ответим вам в ближайшее время, а пока можете оформить заказ — напишите «хочу заказать»."
+)
+
+def build_catalog_answer(mentioned_models, catalog):
+    """Answer from catalog data alone, used when the LLM is backlogged"""
+    available_models = get_available_models(catalog)
+    for model in mentioned_models:
+        in_stock = catalog.filter(model=model)
+        if in_stock:
+            storages = sorted(catalog.distinct('storage', in_stock), key=parse_storage_gb)
+            colors = sorted(catalog.distinct('color', in_stock))
+            answer = (
+                f"{model} есть в наличии 📱\n"
+                f"Объём: {', '.join(storages)}\n"
+                f"Цвета: {', '.join(colors)}"
+            )
+            cheapest = catalog.rows(in_stock, sort_by='price', limit=1)
+            price = parse_price(cheapest[0].get(ColumnarCatalog.PRICE_COLUMN))
+            if price == price:
+                answer += f"\nЦена от {price:,.0f} ₽".replace(",", " ")
+            return answer
+    if mentioned_models:
+        similar_models = find_similar_models(mentioned_models[0], available_models)
+        if similar_models:
+            return f"{mentioned_models[0]} сейчас нет в наличии. Есть похожие модели: {', '.join(similar_models)}"
+    if available_models:
+        return f"Сейчас в наличии: {', '.join(sorted(available_models))}. Какая модель вас интересует?"
+    return OVERLOADED_REPLY
+
+def select_model_tier(prompt, call_site=None):
+    """Pick a model tier for a call site, falling back to prompt size"""
+    tier = CALL_SITE_TIERS.get(call_site)
+    if tier in MODEL_TIERS:
+        return tier
+    return "small" if len(prompt) <= SMALL_PROMPT_MAX_CHARS else "large"
+
+def record_tier_result(tier, latency, error=False):
+    with tier_stats_lock:
+        stats = tier_stats[tier]
+        stats["calls"] += 1
+        stats["total_latency"] += latency
+        if error:
+            stats["errors"] += 1
+
+def get_tier_stats():
+    """Per-tier call counts, average latency and error rate"""
+    with tier_stats_lock:
+        summary = {}
+        for tier, stats in tier_stats.items():
+            calls = stats["calls"]
+            summary[tier] = {
+                "model": MODEL_TIERS[tier]["model"],
+                "calls": calls,
+                "errors": stats["errors"],
+                "avg_latency": round(stats["total_latency"] / calls, 3) if calls else 0.0,
+                "error_rate": round(stats["errors"] / calls, 3) if calls else 0.0
+            }
+        return summary
+
+def record_usage(call_site, model, price, usage, latency, user_state=None):
+    """Add one call's token usage to the call-site, model and session totals"""
+    prompt_tokens = int(usage.get("prompt_tokens") or 0)
+    completion_tokens = int(usage.get("completion_tokens") or 0)
+    cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+    call_site = call_site or "other"
+    with usage_stats_lock:
+        totals = [
+            usage_stats["call_sites"].setdefault(call_site, new_usage_totals()),
+            usage_stats["models"].setdefault(model, new_usage_totals())
+        ]
+        if user_state is not None:
+            totals.append(user_state.token_usage)
+        for entry in totals:
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["total_latency"] += latency
+            entry["cost"] += cost
+    logger.info(
+        "LLM usage: %s via %s", call_site, model,
+        extra={
+            "log_category": "llm_usage",
+            "log_fields": {
+                "call_site": call_site,
+                "model": model,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "latency": round(latency, 3),
+                "cost": round(cost, 6)
+            }
+        }
+    )
+
+def session_over_budget(user_state):
+    if not SESSION_TOKEN_BUDGET:
+        return False
+    usage = user_state.token_usage
+    return usage["prompt_tokens"] + usage["completion_tokens"] >= SESSION_TOKEN_BUDGET
+
+def summarize_usage(totals):
+    calls = totals["calls"]
+    return {
+        "calls": calls,
+        "prompt_tokens": totals["prompt_tokens"],
+        "completion_tokens": totals["completion_tokens"],
+        "total_tokens": totals["prompt_tokens"] + totals["completion_tokens"],
+        "avg_prompt_tokens": round(totals["prompt_tokens"] / calls, 1) if calls else 0.0,
+        "avg_latency": round(totals["total_latency"] / calls, 3) if calls else 0.0,
+        "cost": round(totals["cost"], 6)
+    }
+
+def get_usage_stats(top_sessions=20):
+    """Token usage per call site and model, plus the heaviest sessions"""
+    sessions = [
+        (session_id, user_state.token_usage)
+        for store in store_registry.loaded()
+        for session_id, user_state in list(store.user_states.items())
+    ]
+    with usage_stats_lock:
+        sessions = sorted(
+            ((session_id, dict(usage)) for session_id, usage in sessions if usage["calls"]),
+            key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"],
+            reverse=True
+        )
+        return {
+            "call_sites": {
+                name: summarize_usage(totals) for name, totals in usage_stats["call_sites"].items()
+            },
+            "models": {
+                name: summarize_usage(totals) for name, totals in usage_stats["models"].items()
+            },
+            "sessions": {
+                session_id: summarize_usage(usage) for session_id, usage in sessions[:top_sessions]
+            },
+            "session_token_budget": SESSION_TOKEN_BUDGET or None
+        }
 
-def generate_llama_response(prompt):
+def request_model_tier(tier, prompt, max_tokens=None, call_site=None, user_state=None,
+                       store_name=DEFAULT_STORE_NAME):
+    """Query a single model tier with retries.
+
+    Returns a (content, error_reply) pair; content is None on failure.
+    """
+    tier_config = MODEL_TIERS[tier]
     rate_limited_request()
     
-    url = "https://api.together.xyz/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {TOGETHER_API_KEY}",
         "Content-Type": "application/json"
     }
     
     payload = {
-        "model": "deepseek-ai/DeepSeek-R1-Distill-Llama-70B-free",
+        "model": tier_config["model"],
         "messages": [
             {
                 "role": "system",
                 "content": (
-                    "Вы - консультант магазина WAY PHONE, который продает технику Apple. "
+                    f"Вы - консультант магазина {store_name}, который продает технику Apple. "
                     "Техника Apple как новая, но не новая! Отвечайте кратко и точно на русском. "
                     "Только готовым ответом для клиента без внутренних размышлений! "
                     "Если клиент использует ненормативную лексику, вы имеете право использовать матерные слова в ответ."
@@ -548,66 +1502,113 @@ def generate_llama_response(prompt):
             },
             {"role": "user", "content": prompt}
         ],
-        "temperature": 0.4,
-        "max_tokens": 300
+        "temperature": tier_config["temperature"],
+        "max_tokens": max_tokens or tier_config["max_tokens"]
     }
     
     max_retries = 3
     retry_delay = 2  # seconds
     
     for attempt in range(max_retries):
+        start_time = time.time()
         try:
-            logger.info(f"Sending request to AI model (attempt {attempt+1})")
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            logger.info("Sending request to AI model %s (attempt %d)", tier_config['model'], attempt + 1)
+            response = llm_http.post(TOGETHER_API_URL, headers=headers, json=payload, timeout=30)
             response.raise_for_status()
-            content = response.json()["choices"][0]["message"]["content"].strip()
-            logger.info(f"Raw AI response: {content}")
+            response_data = response.json()
+            content = response_data["choices"][0]["message"]["content"].strip()
+            latency = time.time() - start_time
+            record_tier_result(tier, latency)
+            record_usage(
+                call_site,
+                tier_config["model"],
+                (tier_config["prompt_price"], tier_config["completion_price"]),
+                response_data.get("usage") or {},
+                latency,
+                user_state
+            )
+            logger.info("Raw AI response: %s", content, extra={"log_category": "ai_response"})
             # Clean response from internal thoughts
             cleaned_content = clean_ai_response(content)
-            logger.info(f"Cleaned AI response: {cleaned_content}")
-            return cleaned_content
+            logger.info("Cleaned AI response: %s", cleaned_content,
+                        extra={"log_category": "ai_response"})
+            return cleaned_content, None
         except requests.exceptions.HTTPError as e:
+            record_tier_result(tier, time.time() - start_time, error=True)
             if response.status_code == 429:  # Rate limit
-                logger.warning(f"Rate limit exceeded. Retrying in {retry_delay} seconds...")
+                logger.warning("Rate limit exceeded. Retrying in %s seconds...", retry_delay)
                 time.sleep(retry_delay)
                 retry_delay *= 2  # Exponential backoff
             else:
-                logger.error(f"HTTP error: {str(e)}")
-                return "Извините, временные технические трудности. Попробуйте позже."
+                logger.error("HTTP error: %s", e)
+                return None, LLM_HTTP_ERROR_REPLY
         except Exception as e:
-            logger.error(f"AI error: {str(e)}")
+            record_tier_result(tier, time.time() - start_time, error=True)
+            logger.error("AI error: %s", e)
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
                 retry_delay *= 2
             else:
-                return "Извините, не могу обработать запрос. Попробуйте позже."
+                return None, LLM_FAILED_REPLY
                 
-    return "Извините, сервис временно недоступен. Попробуйте через несколько минут."
+    return None, LLM_UNAVAILABLE_REPLY
+
+def generate_llama_response(prompt, call_site=None, max_tokens=None, user_state=None, store=None):
+    tier = select_model_tier(prompt, call_site)
+    error_reply = LLM_UNAVAILABLE_REPLY
+    
+    fallback_chain = CALL_SITE_FALLBACKS.get(call_site) or MODEL_FALLBACK_CHAINS.get(tier, [tier])
+    for fallback_tier in fallback_chain:
+        fallback_tier = fallback_tier.strip()
+        if fallback_tier not in MODEL_TIERS:
+            continue
+        content, error_reply = request_model_tier(
+            fallback_tier, prompt, max_tokens, call_site, user_state,
+            store.name if store else DEFAULT_STORE_NAME
+        )
+        if content is not None:
+            return content
+        logger.warning("Model tier '%s' failed, trying next in fallback chain", fallback_tier)
+        
+    return error_reply
+
+ORDER_KEYWORDS = [
+    "хочу купить", "хочу заказать", "закажите", "оформить заказ",
+    "куплю", "заказ", "заказать", "оформить", "доставка", "оплата",
+    "купить", "приобрести", "хочу приобрести", "заказал"
+]
 
-def classify_order_intent(user_input, context):
+def classify_order_intent(message, context, user_state=None, store=None):
     """Use NLP to determine if user wants to start an order"""
     # First check for explicit order keywords
-    order_keywords = [
-        "хочу купить", "хочу заказать", "закажите", "оформить заказ",
-        "куплю", "заказ", "заказать", "оформить", "доставка", "оплата",
-        "купить", "приобрести", "хочу приобрести", "заказал"
-    ]
-    
-    if any(keyword in user_input.lower() for keyword in order_keywords):
+    if message.contains_any(ORDER_KEYWORDS):
         return True
         
+    # Skip AI classification when the LLM is backlogged or the session is
+    # over its token budget
+    if get_admission_level(user_state) != "normal":
+        return False
+        
     # Then use AI for context-aware classification
     prompt = f"""
     [КОНТЕКСТ]: {context}
-    [СООБЩЕНИЕ]: {user_input}
+    [СООБЩЕНИЕ]: {message.text}
     Определи намерение одним словом (Заказ или Вопрос):
     - Заказ: если хочет купить/заказать
     - Вопрос: если спрашивает информацию
     """
     
-    response = generate_llama_response(prompt)
+    response = generate_llama_response(
+        prompt, call_site="classify_order_intent", max_tokens=10, user_state=user_state, store=store
+    )
     return "заказ" in response.lower()
 
+def last_assistant_message(chat_history):
+    for msg in reversed(chat_history):
+        if msg["role"] == "assistant":
+            return msg["content"].strip()
+    return ""
+
 def build_context_history(chat_history, max_messages=4):
     """Build context string from chat history"""
     context_parts = []
@@ -623,20 +1624,180 @@ def build_context_history(chat_history, max_messages=4):
             break
     return "\n".join(context_parts)
 
+# Static chat page: rendered once, stored precompressed, served with ETags
+CHAT_PAGE_MAX_AGE = int(os.getenv("CHAT_PAGE_MAX_AGE", "300"))  # seconds
+COMPRESS_MIN_SIZE = 1024  # bytes; smaller JSON replies are sent as is
+
+def compress_body(body, encoding, level):
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level)
+
+def supported_encodings():
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+def choose_encoding(accept_encodings):
+    """Best encoding the client accepts, or None for identity"""
+    encoding = accept_encodings.best_match(supported_encodings() + ["identity"])
+    return None if encoding in (None, "identity") else encoding
+
+def build_static_page(template_name):
+    with app.app_context():
+        body = render_template(template_name).encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    variants = {None: (body, etag)}
+    for encoding in supported_encodings():
+        variants[encoding] = (compress_body(body, encoding, 11 if encoding == "br" else 9), f"{etag}-{encoding}")
+    logger.info(
+        "Prepared %s: %d bytes, %s", template_name, len(body),
+        ", ".join(f"{encoding} {len(data)} bytes" for encoding, (data, _) in variants.items() if encoding)
+    )
+    return variants
+
+chat_page_variants = None  # built by load_shared_state()
+
 # New routes for web chat interface
 @app.route('/')
 def chat_interface():
-    return render_template('chat.html')
+    encoding = choose_encoding(request.accept_encodings)
+    body, etag = chat_page_variants[encoding]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={CHAT_PAGE_MAX_AGE}"
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_json_response(response):
+    """Compress larger JSON replies for clients that accept it"""
+    if (response.mimetype != 'application/json' or
+            response.status_code != 200 or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if not encoding:
+        return response
+    response.set_data(compress_body(body, encoding, 5))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def require_admin(view):
+    """Allow the view only with the ADMIN_TOKEN bearer token"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        authorization = request.headers.get('Authorization', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(
+            authorization.encode('utf-8'), f"Bearer {ADMIN_TOKEN}".encode('utf-8')
+        ):
+            return jsonify({"error": "Unauthorized"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def query_limit(name, default, maximum):
+    """Integer query parameter clamped to 1..maximum; None if not a number"""
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        return None
+    return max(1, min(value, maximum))
+
+@app.route('/llm_stats', methods=['GET'])
+@require_admin
+def llm_stats():
+    return jsonify({
+        "tiers": get_tier_stats(),
+        "admission": get_admission_stats(),
+        "stores": {
+            store.store_id: {"sessions": len(store.user_states)}
+            for store in store_registry.loaded()
+        }
+    })
+
+@app.route('/llm_usage', methods=['GET'])
+@require_admin
+def llm_usage():
+    """Token usage and cost per call site, model and session.
+    Totals are kept in memory per process: under gunicorn each worker reports
+    only its own calls, so sum them from the llm_usage log lines instead."""
+    sessions = query_limit('sessions', 20, 500)
+    if sessions is None:
+        return jsonify({"error": "sessions must be a number"}), 400
+    return jsonify(get_usage_stats(sessions))
+
+@app.route('/debug/profile', methods=['GET'])
+@require_admin
+def debug_profile():
+    """Sample all threads for ?seconds=N and return collapsed stacks, e.g.
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" '.../debug/profile?seconds=10' | flamegraph.pl > profile.svg"""
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval_ms', 5)) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0.001 <= interval <= 1:
+        return jsonify({"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}], interval_ms in [1, 1000]"}), 400
+    result = profiler.profile(seconds, interval, by_thread=request.args.get('by_thread', '1') == '1')
+    if result is None:
+        return jsonify({"error": "A profile is already running"}), 409
+    counts, rounds = result
+    logger.info("Profiled %ss: %d rounds, %d samples", seconds, rounds, sum(counts.values()))
+    response = app.response_class(profiler.format_collapsed(counts), mimetype='text/plain')
+    response.headers['X-Profile-Rounds'] = str(rounds)
+    return response
+
+@app.route('/orders/lookup', methods=['GET'])
+@require_admin
+def orders_lookup():
+    """Staff lookup of mirrored orders by contact, model and date"""
+    since = request.args.get('since')
+    try:
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return jsonify({"error": "since must be an ISO date"}), 400
+    limit = query_limit('limit', 20, 200)
+    if limit is None:
+        return jsonify({"error": "limit must be a number"}), 400
+    store = store_registry.get(request.args.get('store', DEFAULT_STORE_ID))
+    if store is None:
+        return jsonify({"error": "Unknown store"}), 404
+    orders = store.order_mirror.find_orders(
+        contact=request.args.get('contact'),
+        model=request.args.get('model'),
+        since=since,
+        limit=limit
+    )
+    return jsonify({"orders": orders})
 
 @app.route('/start_chat', methods=['POST'])
 def start_chat():
-    session_id = str(uuid.uuid4())
-    user_states[session_id] = UserState()
-    chat_histories[session_id] = []
-    # Preload products to warm up cache
-    get_available_products()
+    data = request.get_json(silent=True) or {}
+    store_id = str(data.get('store_id') or request.args.get('store') or DEFAULT_STORE_ID)
+    session_id = make_session_id(store_id)
+    # Behind the session-affinity dispatcher the session id is assigned by
+    # the dispatcher, so it hashes to this worker
+    assigned_session_id = request.headers.get('X-Session-Id')
+    if (SESSION_AFFINITY_WORKER and assigned_session_id and
+            assigned_session_id.startswith(f"{store_id}:") and
+            request.remote_addr in ('127.0.0.1', '::1')):
+        session_id = assigned_session_id
+    store = store_registry.start_session(store_id, session_id)
+    if store is None:
+        return jsonify({"error": "Unknown store"}), 404
+    # Warm up product cache without blocking the response
+    store.warm_product_cache_async()
     return jsonify({
-        "session_id": session_id
+        "session_id": session_id,
+        "messages": list(store.initial_messages)
     })
 
 @app.route('/send_message', methods=['POST'])
@@ -645,13 +1806,63 @@ def send_message():
     session_id = data.get('session_id')
     user_input = data.get('message').strip()
     
-    if not session_id or session_id not in user_states:
+    cleanup_expired_sessions()
+    store, user_state = get_session(session_id)
+    if user_state is None:
         return jsonify({"error": "Invalid session"}), 400
         
+    assistant_reply = process_message(store, session_id, user_input)
+    return jsonify({"message": assistant_reply})
+
+@app.route('/send_messages', methods=['POST'])
+def send_messages():
+    """Process a batch of {session_id, message} items in one request.
+
+    Different sessions run concurrently, messages of one session run in the
+    order given. Replies are returned in input order.
+    """
+    data = request.json or {}
+    items = data.get('messages')
+    if not isinstance(items, list):
+        return jsonify({"error": "messages must be a list"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large (max {MAX_BATCH_SIZE})"}), 400
+        
+    # Housekeeping once per batch
     cleanup_expired_sessions()
-    user_state = user_states[session_id]
+    
+    replies = [None] * len(items)
+    session_queues = OrderedDict()
+    for index, item in enumerate(items):
+        session_id = item.get('session_id') if isinstance(item, dict) else None
+        message = item.get('message') if isinstance(item, dict) else None
+        store, user_state = get_session(session_id)
+        if user_state is None or not isinstance(message, str):
+            replies[index] = {"session_id": session_id, "error": "Invalid session"}
+            continue
+        session_queues.setdefault(session_id, (store, []))[1].append((index, message.strip()))
+        
+    def process_session(session_id, store, queued_messages):
+        for index, message in queued_messages:
+            try:
+                reply = {"session_id": session_id, "message": process_message(store, session_id, message)}
+            except Exception as e:
+                logger.error("Batch message error for session %s: %s", session_id, e)
+                reply = {"session_id": session_id, "error": "Processing failed"}
+            replies[index] = reply
+            
+    if session_queues:
+        with ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(session_queues))) as executor:
+            for session_id, (store, queued_messages) in session_queues.items():
+                executor.submit(process_session, session_id, store, queued_messages)
+                
+    return jsonify({"replies": replies})
+
+def process_message(store, session_id, user_input):
+    """Run one user message through the state machine and return the reply"""
+    user_state = store.user_states[session_id]
     user_state.last_active = datetime.now()
-    chat_history = chat_histories[session_id]
+    chat_history = store.chat_histories[session_id]
     
     # Add user message to history
     chat_history.append({"role": "user", "content": user_input})
@@ -659,43 +1870,34 @@ def send_message():
     if user_state.reset_context:
         if chat_history and chat_history[-1]["role"] == "assistant":
             chat_history = [chat_history[-1]]
-            chat_histories[session_id] = chat_history
+            store.chat_histories[session_id] = chat_history
         user_state.reset_context = False
         
     # Trim history if needed
     if user_state.order_confirmed and not user_state.context_cut:
         if len(chat_history) > 2:
             chat_history = chat_history[-2:]
-            chat_histories[session_id] = chat_history
+            store.chat_histories[session_id] = chat_history
         user_state.context_cut = True
     elif len(chat_history) > MAX_CONTEXT and not user_state.context_cut:
         chat_history.pop(0)
         
-    # Check if we need to send initial messages
-    if not user_state.initial_messages_sent:
-        user_state.initial_messages_sent = True
-        initial_messages = [greeting_text] + details_texts
-        
-        # Add initial messages to chat history
-        for msg in initial_messages:
-            chat_history.append({"role": "assistant", "content": msg})
-            
-        # Return initial messages without processing user input
-        return jsonify({"messages": initial_messages})
-        
+    # Analyze the message once for all handlers
+    message = MessageAnalysis(user_input)
+    
     # Route to appropriate handler
     if user_state.phase == "init":
-        response = handle_product_inquiry(user_input, user_state, session_id)
+        response = handle_product_inquiry(message, user_state, store, session_id)
     elif user_state.phase == "order_confirmation":
-        response = handle_order_confirmation(user_input, user_state)
+        response = handle_order_confirmation(message, user_state, store)
     elif user_state.phase == "product_info":
-        response = handle_product_info_response(user_input, user_state, session_id)
+        response = handle_product_info_response(message, user_state, store, session_id)
     elif user_state.phase == "delivery_selection":
-        response = handle_delivery_selection(user_input, user_state)
+        response = handle_delivery_selection(message, user_state, store)
     elif user_state.phase == "order_form":
-        response = handle_order_form_step(user_input, user_state, session_id)
+        response = handle_order_form_step(message, user_state, store, session_id)
     elif user_state.phase == "complete":
-        response = handle_complete_phase(user_input, user_state, session_id)
+        response = handle_complete_phase(message, user_state, store, session_id)
     else:
         response = "Произошла ошибка. Пожалуйста, попробуйте позже."
         
@@ -710,13 +1912,13 @@ def send_message():
     # Handle context reset flag
     if user_state.reset_context:
         if chat_history and chat_history[-1]["role"] == "assistant":
-            chat_histories[session_id] = [chat_history[-1]]
+            store.chat_histories[session_id] = [chat_history[-1]]
         user_state.reset_context = False
         
-    return jsonify({"message": assistant_reply})
+    return assistant_reply
 
-def handle_complete_phase(user_input, user_state, session_id):
-    if any(word in user_input.lower() for word in ["новый", "еще", "другой", "ещё"]):
+def handle_complete_phase(message, user_state, store, session_id):
+    if message.contains_any(["новый", "еще", "другой", "ещё"]):
         user_state.phase = "init"
         user_state.order_confirmed = False
         user_state.context_cut = False
@@ -732,25 +1934,41 @@ def handle_complete_phase(user_input, user_state, session_id):
         return "Хорошо, давайте оформим новый заказ. Какой iPhone вас интересует?"
     else:
         user_state.phase = "init"
-        return handle_product_inquiry(user_input, user_state, session_id)
+        return handle_product_inquiry(message, user_state, store, session_id)
 
-def handle_product_inquiry(user_input, user_state, session_id):
+def handle_product_inquiry(message, user_state, store, session_id):
     user_state.greeted = True
     
     # Get conversation context
-    chat_history = chat_histories.get(session_id, [])
+    chat_history = store.chat_histories.get(session_id, [])
     context = build_context_history(chat_history)
     
+    # Order status questions are answered from the local order mirror
+    status_reply = handle_order_status_question(message, user_state, store)
+    if status_reply:
+        user_state.phase = "init"
+        return status_reply
+        
+    # Answer common questions straight from the FAQ texts, before spending
+    # an LLM call on intent classification. A reply to our own question
+    # ("…Оформим заказ?") goes to the classifier instead.
+    faq_results = store.faq_index.search(message.text)
+    faq_answer = find_direct_faq_answer(faq_results, message.text)
+    if (faq_answer and not message.contains_any(ORDER_KEYWORDS) and
+            not last_assistant_message(chat_history).endswith('?')):
+        user_state.phase = "init"
+        return faq_answer
+        
     # Advanced NLP intent recognition
-    wants_to_order = classify_order_intent(user_input, context)
+    wants_to_order = classify_order_intent(message, context, user_state, store)
     
     # Check for explicit order requests
     if (wants_to_order or 
-        any(word in user_input.lower() for word in ["хочу купить", "хочу заказать"])):
+        message.contains_any(["хочу купить", "хочу заказать"])):
         user_state.order_intent_detected = True
         
         # Extract mentioned model from context
-        mentioned_models = extract_models_from_input(context + " " + user_input)
+        mentioned_models = extract_models_from_input(context + " " + message.text)
         
         if mentioned_models:
             model = mentioned_models[0]
@@ -761,8 +1979,22 @@ def handle_product_inquiry(user_input, user_state, session_id):
             user_state.phase = "order_confirmation"
             return "Отлично! Какую модель iPhone вы хотели бы заказать?"
             
-    products = get_available_products()
-    available_models = get_available_models(products)
+    catalog = store.get_catalog_store()
+    available_models = get_available_models(catalog)
+    
+    # Degrade gracefully when the LLM queue is backed up
+    admission_level = get_admission_level(user_state)
+    if admission_level != "normal":
+        user_state.phase = "init"
+        cached_answer = (
+            get_cached_answer(store.store_id, message.text)
+            if is_cacheable_question(message) else None
+        )
+        if cached_answer:
+            return cached_answer
+        if admission_level == "degraded":
+            return build_catalog_answer(message.models, catalog)
+        return OVERLOADED_REPLY
     
     # Create a concise list of available models for the prompt
     models_list = ", ".join(available_models[:5])  # Show first 5 models
@@ -770,10 +2002,17 @@ def handle_product_inquiry(user_input, user_state, session_id):
     if len(available_models) > 5:
         models_list += f" и ещё {len(available_models)-5} моделей"
         
+    # Only the most relevant FAQ passages go into the prompt
+    faq_passages = "\n".join(
+        passage for _, passage, _ in faq_results[:RETRIEVAL_PROMPT_PASSAGES]
+    ) or "нет"
+        
     # Build context-aware prompt
     prompt = f"""
     [КОНТЕКСТ РАЗГОВОРА]
     {context}
+    [СПРАВКА]
+    {faq_passages}
     [ИНСТРУКЦИИ]
     Ты консультант магазина. Отвечай только готовым ответом для клиента без внутренних размышлений.
     Отвечай на русском. Только готовым ответом для клиента без внутренних размышлений!
@@ -781,16 +2020,21 @@ def handle_product_inquiry(user_input, user_state, session_id):
     - Используй дружелюбный тон с эмодзи иногда
     - Не упоминай, что ты ИИ
     - Опирайся только на доступные модели: {models_list}
+    - Используй факты из справки, если они относятся к вопросу
     [ЗАПРОС]
-    Клиент спрашивает: {user_input}
+    Клиент спрашивает: {message.text}
     """
     
-    ai_response = generate_llama_response(prompt)
+    ai_response = generate_llama_response(
+        prompt, call_site="handle_product_inquiry", user_state=user_state, store=store
+    )
+    if is_cacheable_question(message):
+        cache_answer(store.store_id, message.text, ai_response)
     
     # Check if we should ask about details
     if (not user_state.greeted and
-            not any(word in user_input.lower() for word in ["нет", "не надо"]) and
-            any(model.lower() in user_input.lower() for model in ["iphone", "айфон"])):
+            not message.declines and
+            message.contains_any(["iphone", "айфон"])):
         user_state.phase = "product_info"
         user_state.asked_for_details = True
         return f"{ai_response}\nХотите получить полную информацию по конкретной модели?"
@@ -798,24 +2042,24 @@ def handle_product_inquiry(user_input, user_state, session_id):
         user_state.phase = "init"
         return ai_response
 
-def handle_order_confirmation(user_input, user_state):
-    if user_input.lower() in ["да", "yes", "д"]:
+def handle_order_confirmation(message, user_state, store):
+    if message.is_yes:
         user_state.phase = "delivery_selection"
-        return delivery_options_text
-    elif user_input.lower() in ["нет", "no", "н"]:
+        return store.delivery_options_text
+    elif message.is_no:
         user_state.phase = "init"
         user_state.order_intent_detected = False
         return "Хорошо, чем еще могу помочь?"
     else:
         return "Пожалуйста, ответьте Да или Нет:"
 
-def handle_product_info_response(user_input, user_state, session_id):
-    if any(word in user_input.lower() for word in ["нет", "не надо"]):
+def handle_product_info_response(message, user_state, store, session_id):
+    if message.declines:
         user_state.phase = "init"
         user_state.asked_for_details = False
         return "Хорошо, чем еще могу помочь?"
         
-    model_query = extract_models_from_input(user_input)
+    model_query = message.models
     
     if model_query:
         model_query = model_query[0]
@@ -823,15 +2067,25 @@ def handle_product_info_response(user_input, user_state, session_id):
         model_query = re.sub(
             r'\b(да|про|информация|подробнее|хочу|модель)\b',
             '',
-            user_input,
+            message.text,
             flags=re.IGNORECASE
         ).strip()
         
-    products = get_available_products()
-    available_models = get_available_models(products)
+    catalog = store.get_catalog_store()
+    available_models = get_available_models(catalog)
+    
+    # Degrade gracefully when the LLM queue is backed up
+    admission_level = get_admission_level(user_state)
+    if admission_level == "overloaded":
+        user_state.phase = "init"
+        return OVERLOADED_REPLY
+    if admission_level == "degraded":
+        user_state.asked_for_details = True
+        user_state.phase = "delivery_selection"
+        return f"{build_catalog_answer(message.models, catalog)}\nХотите оформить заказ на эту модель?"
     
     # Build context
-    chat_history = chat_histories.get(session_id, [])
+    chat_history = store.chat_histories.get(session_id, [])
     context = build_context_history(chat_history)
     
     # Create a concise list of available models for the prompt
@@ -854,7 +2108,9 @@ def handle_product_info_response(user_input, user_state, session_id):
     Клиент спрашивает про: {model_query}
     """
     
-    ai_response = generate_llama_response(prompt)
+    ai_response = generate_llama_response(
+        prompt, call_site="handle_product_info_response", user_state=user_state, store=store
+    )
     
     # Add order prompt if not already present
     if "Хотите оформить заказ" not in ai_response:
@@ -864,15 +2120,15 @@ def handle_product_info_response(user_input, user_state, session_id):
     user_state.phase = "delivery_selection"
     return ai_response
 
-def handle_delivery_selection(user_input, user_state):
-    if "нет" in user_input.lower():
+def handle_delivery_selection(message, user_state, store):
+    if message.declines:
         user_state.phase = "init"
         return "Хорошо, чем еще могу помочь?"
         
-    delivery = match_delivery_option(user_input)
+    delivery = message.delivery
     
     if not delivery:
-        return f"Пожалуйста, выберите способ доставки:\n{delivery_options_text}"
+        return f"Пожалуйста, выберите способ доставки:\n{store.delivery_options_text}"
         
     user_state.delivery_method = delivery
     
@@ -881,11 +2137,11 @@ def handle_delivery_selection(user_input, user_state):
     user_state.current_order_step = "full_name"
     return "Пожалуйста, укажите ваше полное имя (Фамилия Имя Отчество):"
 
-def handle_order_form_step(user_input, user_state, session_id):
-    products = get_available_products()
+def handle_order_form_step(message, user_state, store, session_id):
+    products = store.get_catalog_store()
     
     if user_state.current_order_step == "full_name":
-        name_parts = user_input.split()
+        name_parts = message.text.split()
         
         if len(name_parts) < 2:
             return "Пожалуйста, укажите ваше полное имя (минимум Фамилия и Имя):"
@@ -896,8 +2152,8 @@ def handle_order_form_step(user_input, user_state, session_id):
         return "Укажите ваш телефон (в формате +7XXXXXXXXXX) или Telegram username (в формате @username):"
         
     elif user_state.current_order_step == "contact":
-        phone_match = re.match(r'^(\+7|7|8)?(\d{10})$', user_input)
-        telegram_match = re.match(r'^@?[a-zA-Z0-9_]{5,32}$', user_input)
+        phone_match = re.match(r'^(\+7|7|8)?(\d{10})$', message.text)
+        telegram_match = re.match(r'^@?[a-zA-Z0-9_]{5,32}$', message.text)
         
         if phone_match:
             phone = "+7" + phone_match.group(2)
@@ -916,19 +2172,20 @@ def handle_order_form_step(user_input, user_state, session_id):
         return "Укажите модель iPhone, которую вы хотите заказать:"
         
     elif user_state.current_order_step == "model":
-        model_input = user_input.strip()
-        all_products = get_available_products()
+        model_input = message.text
+        all_products = store.get_available_products()
         normalized_input = normalize_model_name(model_input)
         best_match = None
         best_score = 0
         
-        for product in all_products:
-            product_norm = normalize_model_name(product.get('Модель', ''))
+        # Each distinct model name is compared once, not once per row
+        for model_name in products.distinct('model', products.all_rows):
+            product_norm = normalize_model_name(model_name)
             similarity = jellyfish.jaro_similarity(normalized_input, product_norm)
             
             if similarity > best_score:
                 best_score = similarity
-                best_match = product.get('Модель', '')
+                best_match = model_name
                 
         if not best_match or best_score < 0.8:
             best_match = model_input
@@ -936,10 +2193,7 @@ def handle_order_form_step(user_input, user_state, session_id):
         matched_products = find_matching_products(all_products, model=best_match)
         
         if not matched_products:
-            model_exists = any(
-                normalize_model_name(p.get('Модель', '')) == normalize_model_name(best_match)
-                for p in all_products
-            )
+            model_exists = bool(products.filter(model=best_match, in_stock=False))
             
             if model_exists:
                 user_state.current_order_step = "out_of_stock"
@@ -959,11 +2213,11 @@ def handle_order_form_step(user_input, user_state, session_id):
         return f"Вы имели в виду {matched_products[0].get('Модель', '')}? (Да/Нет)"
         
     elif user_state.current_order_step == "model_confirmation":
-        if user_input.lower() in ["да", "yes", "д"]:
+        if message.is_yes:
             user_state.current_order_step = "storage"
             storages = get_available_storages(products, user_state.order_data["Модель"])
             return f"✅ Выбрана модель: {user_state.order_data['Модель']}. Выберите объём памяти: {', '.join(storages)}"
-        elif user_input.lower() in ["нет", "no", "н"]:
+        elif message.is_no:
             user_state.order_data["Модель"] = ""
             user_state.current_order_step = "model"
             return "Хорошо, пожалуйста, укажите точное название модели:"
@@ -971,14 +2225,14 @@ def handle_order_form_step(user_input, user_state, session_id):
             return "Пожалуйста, ответьте Да или Нет для подтверждения модели:"
             
     elif user_state.current_order_step == "out_of_stock":
-        if user_input.lower() in ["да", "yes", "д"]:
+        if message.is_yes:
             user_state.order_data["Модель"] = ""
             user_state.order_data["Объём"] = ""
             user_state.order_data["Цвет"] = ""
             user_state.order_data["Зарядный блок"] = "Нет"
             user_state.current_order_step = "model"
             return "Укажите модель iPhone, которую вы хотите заказать:"
-        elif user_input.lower() in ["нет", "no", "н"]:
+        elif message.is_no:
             user_state.phase = "init"
             user_state.order_data = {
                 "ФИО": "",
@@ -993,7 +2247,7 @@ def handle_order_form_step(user_input, user_state, session_id):
             return "Пожалуйста, ответьте Да или Нет:"
             
     elif user_state.current_order_step == "storage":
-        storage_input = normalize_storage(user_input)
+        storage_input = message.storage
         model = user_state.order_data["Модель"]
         available_storages = get_available_storages(products, model)
         
@@ -1015,7 +2269,7 @@ def handle_order_form_step(user_input, user_state, session_id):
                 return f"Объём недоступен. Выберите: {', '.join(available_storages)}"
                 
     elif user_state.current_order_step == "color":
-        color_input = normalize_color(user_input)
+        color_input = message.color
         model = user_state.order_data["Модель"]
         storage = user_state.order_data["Объём"]
         available_colors = get_available_colors(products, model, storage)
@@ -1024,14 +2278,14 @@ def handle_order_form_step(user_input, user_state, session_id):
             if normalize_color(color) == color_input:
                 user_state.order_data["Цвет"] = color
                 user_state.current_order_step = "charger"
-                return f"🎨 Выбран цвет: {color}. Нужен зарядный блок (20W, 2500₽)? Ответьте Да или Нет:"
+                return f"🎨 Выбран цвет: {color}. Нужен зарядный блок (20W, {store.charger_price}₽)? Ответьте Да или Нет:"
                 
         return f"Цвет недоступен. Выберите: {', '.join(available_colors)}"
         
     elif user_state.current_order_step == "charger":
-        if user_input.lower() in ["да", "yes", "д"]:
+        if message.is_yes:
             user_state.order_data["Зарядный блок"] = "Да"
-        elif user_input.lower() in ["нет", "no", "н"]:
+        elif message.is_no:
             user_state.order_data["Зарядный блок"] = "Нет"
         else:
             return "Пожалуйста, ответьте Да или Нет на вопрос о зарядном блоке:"
@@ -1039,20 +2293,29 @@ def handle_order_form_step(user_input, user_state, session_id):
         user_state.order_data["Доставка"] = user_state.delivery_method
         user_state.current_order_step = "confirmation"
         order_summary = format_order_summary(user_state.order_data)
+        duplicate = find_duplicate_order(store, user_state.order_data)
+        if duplicate:
+            created = datetime.fromisoformat(duplicate["created_at"]).strftime("%d.%m.%Y")
+            order_summary += f"\n⚠️ На этот контакт уже есть заказ {duplicate['model']} от {created}."
         return f"{order_summary}\nВсё верно? Подтвердите заказ (Да/Нет):"
         
     elif user_state.current_order_step == "confirmation":
-        if user_input.lower() in ["да", "yes", "д"]:
-            if submit_order(user_state.order_data):
+        if message.is_yes:
+            order_status = submit_order(store, user_state.order_data)
+            if order_status != ORDER_FAILED:
                 user_state.phase = "complete"
                 user_state.order_confirmed = True
                 user_state.reset_context = True
+                if order_status == ORDER_PENDING:
+                    reply = "⏳ Заказ принят и сохраняется, повторно оформлять не нужно. Мы свяжемся с вами для уточнения деталей. Хотите оформить еще один заказ?"
+                else:
+                    reply = "✅ Заказ оформлен! Мы свяжемся с вами для уточнения деталей. Хотите оформить еще один заказ?"
                 return {
-                    "reply": "✅ Заказ оформлен! Мы свяжемся с вами для уточнения деталей. Хотите оформить еще один заказ?",
+                    "reply": reply,
                     "order_complete": True
                 }
             return "Ошибка при обработке заказа. Пожалуйста, попробуйте позже."
-        elif user_input.lower() in ["нет", "no", "н"]:
+        elif message.is_no:
             user_state.phase = "init"
             return "Хорошо, заказ отменён. Хотите выбрать другую модель или уточнить детали?"
         else:
@@ -1060,5 +2323,101 @@ def handle_order_form_step(user_input, user_state, session_id):
             
     return "Произошла ошибка. Пожалуйста, попробуйте позже."
 
+# Process lifecycle. Importing this module only defines things; it starts no
+# threads and opens no connections. create_app() builds the read-only data
+# every process shares and init_worker() creates the per-process resources
+# (logging thread, HTTP pool, Sheets client, background threads). Under
+# gunicorn --preload, create_app(preload=True) runs once in the master and
+# init_worker() runs in each worker after fork (see gunicorn.conf.py), so
+# workers share the preloaded pages copy-on-write.
+import_pid = os.getpid()
+process_pid = None  # process whose logging, scheduler and HTTP pool exist
+worker_pid = None  # process that finished init_worker()
+shared_state_loaded = False
+worker_init_lock = threading.Lock()
+
+def load_shared_state(snapshot_catalog=False):
+    """Build the read-only data all workers share: the chat page and the
+    default store's texts and FAQ index, plus a catalog snapshot if asked.
+    Leaves no threads or sockets behind, so it is safe to fork afterwards."""
+    global chat_page_variants, shared_state_loaded
+    if shared_state_loaded:
+        return
+    chat_page_variants = build_static_page('chat.html')
+    store = store_registry.get(DEFAULT_STORE_ID)
+    if snapshot_catalog and sheets_scheduler.connect():
+        try:
+            store.set_products(sheets_scheduler.execute(store.read_products))
+        except Exception as e:
+            logger.error("Catalog preload failed: %s", e)
+        # Workers open their own Sheets clients after fork
+        store.release_sheets()
+        sheets_scheduler.gc = None
+    shared_state_loaded = True
+
+def init_process_resources():
+    """Logging thread, Sheets scheduler and HTTP pool; once per process"""
+    global process_pid, sheets_scheduler, llm_http
+    if process_pid == os.getpid():
+        return
+    start_logging()
+    if os.getpid() != import_pid:
+        # Forked from a preloaded master: start from a clean scheduler
+        sheets_scheduler = SheetsScheduler(SHEETS_QUOTA_PER_MINUTE)
+    llm_http = requests.Session()
+    llm_http.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=len(MODEL_TIERS), pool_maxsize=LLM_HTTP_POOL_SIZE
+    ))
+    process_pid = os.getpid()
+
+def init_worker():
+    """Create per-process resources and connect to Sheets; runs once per
+    process. Raises if Sheets is unreachable; a retry only repeats the
+    connection, the resources above are not created twice."""
+    global worker_pid
+    with worker_init_lock:
+        if worker_pid == os.getpid():
+            return
+        init_process_resources()
+        load_shared_state()
+        if not initialize_google_sheets():
+            raise RuntimeError("Google Sheets connection failed")
+        # Load the default store's catalog in the background so the first
+        # chat does not wait on Sheets
+        store_registry.get(DEFAULT_STORE_ID).warm_product_cache_async()
+        threading.Thread(
+            target=run_order_reconciliation,
+            name="order-reconciler",
+            daemon=True
+        ).start()
+        worker_pid = os.getpid()
+        logger.info("Worker %s initialized", worker_pid)
+
+@app.before_request
+def ensure_worker_initialized():
+    # Covers servers that import `app:app` directly or fork without hooks
+    if worker_pid != os.getpid():
+        init_worker()
+
+def create_app(preload=False):
+    """App factory. With preload=True only shared data is built, and it is
+    moved out of the garbage collector's reach so that collections in the
+    workers do not touch (and un-share) its pages; the master's logging
+    thread is stopped before gunicorn forks. Call init_worker() after fork.
+    Otherwise the process is fully initialized."""
+    if not preload:
+        init_worker()
+        return app
+    start_logging()
+    load_shared_state(snapshot_catalog=True)
+    stop_logging()
+    gc.collect()
+    gc.freeze()
+    return app
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=10000, debug=True)
+    create_app().run(
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "10000")),
+        debug=os.getenv("FLASK_DEBUG", "1") == "1"
+    )
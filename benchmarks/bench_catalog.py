@@ -0,0 +1,268 @@
+"""Scaling microbenchmarks for catalog normalization and matching.
+
+Generates synthetic catalogs (100 to 1M rows by default) and noisy
+Russian/English customer queries, times each function from catalog.py with
+warm-up and repetitions, and reports ops/sec and peak memory.
+
+find_similar_models scans the list of distinct model names rather than the
+catalog, so it is measured against model lists of --model-counts names.
+
+Timings depend on the machine, so no baseline is kept in the repo. Record one
+from the base branch in a separate worktree, then compare the change against
+it on the same machine:
+
+    git worktree add /tmp/bench-base main
+    python /tmp/bench-base/benchmarks/bench_catalog.py --max-rows 10000 --output bench.json
+    python benchmarks/bench_catalog.py --max-rows 10000 --baseline bench.json
+    git worktree remove /tmp/bench-base
+
+With --baseline the run exits with status 1 if any benchmark is slower than
+the baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import (  # noqa: E402
+    normalize_model_name,
+    normalize_storage,
+    normalize_color,
+    find_matching_products,
+    find_similar_models,
+    extract_models_from_input,
+    get_available_colors,
+    ColumnarCatalog
+)
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000, 1000000]
+DEFAULT_MODEL_COUNTS = [30, 300, 3000]
+MODEL_NUMBERS = ["11", "12", "13", "14", "15", "16"]
+MODEL_VARIANTS = ["", " Pro", " Pro Max", " Plus", " Mini"]
+STORAGES = ["64", "128", "256", "512", "1024", "128 GB", "256 ГБ", "1 TB"]
+COLORS = [
+    "Черный", "Белый", "Синий", "Красный", "Золотой", "Серебристый",
+    "Space Gray", "Midnight", "Starlight", "Натуральный титан", "Голубой титан"
+]
+AVAILABILITY = ["да", "в наличии", "нет", "yes", "есть", ""]
+# Other product lines, numbered upwards to grow model lists past the iPhones
+EXTRA_MODEL_LINES = ["Galaxy S", "Galaxy A", "Redmi Note ", "Pixel ", "Xperia ", "Nothing Phone "]
+
+QUERY_PREFIXES = ["iphone ", "айфон ", "Iphone", "АЙФОН ", "хочу айфон ", "есть iphone ", ""]
+QUERY_VARIANTS = {
+    "": ["", " стандарт", " обычный"],
+    " Pro": [" pro", " про", " прo", " рго"],
+    " Pro Max": [" pro max", " промакс", " про макс", " promax"],
+    " Plus": [" plus", " плюс", " плс"],
+    " Mini": [" mini", " мини", " мин"]
+}
+QUERY_SUFFIXES = ["", " 256 гб", " 128gb черный", " синий", "?", " в наличии?"]
+NOISY_COLORS = ["черный", "чёрный", "чорный", "белый", "белыи", "space grey", "spacegray", "голубой", "синий", "золото"]
+
+def add_typo(text, rng):
+    if len(text) < 4:
+        return text
+    position = rng.randrange(1, len(text) - 1)
+    kind = rng.random()
+    if kind < 0.33:
+        return text[:position] + text[position + 1:]
+    if kind < 0.66:
+        return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+    return text[:position] + text[position] + text[position:]
+
+def generate_catalog(rows, rng):
+    return [
+        {
+            "Модель": f"iPhone {rng.choice(MODEL_NUMBERS)}{rng.choice(MODEL_VARIANTS)}",
+            "Объём": rng.choice(STORAGES),
+            "Цвет": rng.choice(COLORS),
+            "Наличие": rng.choice(AVAILABILITY)
+        }
+        for _ in range(rows)
+    ]
+
+def generate_model_names(count):
+    """The iPhone names from the catalog, then other lines until `count` names"""
+    names = [f"iPhone {number}{variant}" for number in MODEL_NUMBERS for variant in MODEL_VARIANTS]
+    number = 1
+    while len(names) < count:
+        for line in EXTRA_MODEL_LINES:
+            for variant in MODEL_VARIANTS:
+                names.append(f"{line}{number}{variant}")
+        number += 1
+    return sorted(names[:count])
+
+def generate_queries(count, rng):
+    queries = []
+    for _ in range(count):
+        variant = rng.choice(list(QUERY_VARIANTS))
+        query = (
+            rng.choice(QUERY_PREFIXES)
+            + rng.choice(MODEL_NUMBERS)
+            + rng.choice(QUERY_VARIANTS[variant])
+            + rng.choice(QUERY_SUFFIXES)
+        )
+        if rng.random() < 0.3:
+            query = add_typo(query, rng)
+        queries.append(query)
+    return queries
+
+def measure(func, inputs, repeat, warmup):
+    """Time one pass of func over inputs; returns stats over `repeat` passes"""
+    for _ in range(warmup):
+        for item in inputs:
+            func(item)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in inputs:
+            func(item)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    for item in inputs:
+        func(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best = min(timings)
+    return {
+        "ops": len(inputs),
+        "ops_per_sec": round(len(inputs) / best, 2) if best else None,
+        "best_s": round(best, 6),
+        "mean_s": round(statistics.mean(timings), 6),
+        "stdev_s": round(statistics.stdev(timings), 6) if len(timings) > 1 else 0.0,
+        "peak_kib": round(peak / 1024, 1)
+    }
+
+def run_benchmarks(sizes, model_counts, query_count, scan_queries, repeat, warmup, seed):
+    rng = random.Random(seed)
+    queries = generate_queries(query_count, rng)
+    results = {}
+
+    # Per-query functions are independent of catalog size
+    results["normalize_model_name"] = measure(normalize_model_name, queries, repeat, warmup)
+    storage_inputs = [rng.choice(STORAGES + ["1тб", "256 гб", "512GB"]) for _ in range(query_count)]
+    results["normalize_storage"] = measure(normalize_storage, storage_inputs, repeat, warmup)
+    color_inputs = [rng.choice(COLORS + NOISY_COLORS) for _ in range(query_count)]
+    results["normalize_color"] = measure(normalize_color, color_inputs, repeat, warmup)
+    results["extract_models_from_input"] = measure(extract_models_from_input, queries, repeat, warmup)
+
+    for count in model_counts:
+        available_models = generate_model_names(count)
+        # Each query normalizes every model name, so long lists get fewer queries
+        model_inputs = queries if count < 1000 else queries[:max(1, scan_queries)]
+        results[f"find_similar_models[models={count}]"] = measure(
+            lambda query: find_similar_models(query, available_models),
+            model_inputs, repeat, warmup
+        )
+
+    for rows in sizes:
+        catalog = generate_catalog(rows, rng)
+        # Full catalog scans get fewer queries so large sizes stay tractable
+        scan_inputs = queries[:max(1, scan_queries if rows < 100000 else 1)]
+        scan_repeat = repeat if rows < 100000 else 1
+        results[f"find_matching_products[rows={rows}]"] = measure(
+            lambda query: find_matching_products(catalog, model=query, storage="256", color="черный"),
+            scan_inputs, scan_repeat, warmup if rows < 100000 else 0
+        )
+        results[f"get_available_colors[rows={rows}]"] = measure(
+            lambda query: get_available_colors(catalog, query, "256"),
+            scan_inputs, scan_repeat, warmup if rows < 100000 else 0
+        )
+        columnar = ColumnarCatalog(catalog)
+        results[f"ColumnarCatalog.filter+distinct[rows={rows}]"] = measure(
+            lambda query: columnar.distinct('color', columnar.filter(model=query, storage="256")),
+            queries, repeat, warmup
+        )
+        results[f"ColumnarCatalog.range+sort[rows={rows}]"] = measure(
+            lambda query: columnar.rows(columnar.filter(model=query, min_storage_gb=256), sort_by='storage_gb', limit=5),
+            queries, repeat, warmup
+        )
+        print(f"  finished catalog size {rows}", file=sys.stderr)
+    return results
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return descriptions of benchmarks slower than baseline by > tolerance"""
+    regressions = []
+    for name, baseline_result in baseline.get("results", {}).items():
+        current = results.get(name)
+        if not current or not current["ops_per_sec"] or not baseline_result.get("ops_per_sec"):
+            continue
+        ratio = current["ops_per_sec"] / baseline_result["ops_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append(
+                f"{name}: {current['ops_per_sec']:.1f} ops/s vs baseline "
+                f"{baseline_result['ops_per_sec']:.1f} ops/s ({(1 - ratio) * 100:.0f}% slower)"
+            )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma-separated catalog sizes")
+    parser.add_argument("--max-rows", type=int, default=None, help="skip sizes above this")
+    parser.add_argument("--model-counts", default=",".join(str(count) for count in DEFAULT_MODEL_COUNTS),
+                        help="comma-separated model list sizes for find_similar_models")
+    parser.add_argument("--queries", type=int, default=500, help="queries per benchmark")
+    parser.add_argument("--scan-queries", type=int, default=20,
+                        help="queries per full-catalog scan benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="compare against a previous results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown vs baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    if args.max_rows:
+        sizes = [size for size in sizes if size <= args.max_rows]
+
+    model_counts = [int(count) for count in args.model_counts.split(",") if count]
+
+    results = run_benchmarks(
+        sizes, model_counts, args.queries, args.scan_queries, args.repeat, args.warmup, args.seed
+    )
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "sizes": sizes,
+            "model_counts": model_counts,
+            "queries": args.queries
+        },
+        "results": results
+    }
+
+    name_width = max(len(name) for name in results)
+    for name, result in results.items():
+        print(f"{name:<{name_width}}  {result['ops_per_sec']:>12,.1f} ops/s  "
+              f"{result['mean_s'] * 1000:>10.2f} ms/pass  {result['peak_kib']:>9.1f} KiB peak")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("\nPerformance regressions:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+import re
+import math
+import bisect
+import string
+import difflib
+import itertools
+import jellyfish
+
+MODEL_PATTERNS = {
+    'pro': ['pro', 'про', 'рго', 'прo', 'пpo'],
+    'max': ['max', 'макс', 'маx', 'мaкс', 'мax'],
+    'mini': ['mini', 'мини', 'минь', 'миni', 'мин'],
+    'plus': ['plus', 'плюс', 'плс', 'pls', 'плю'],
+    'standard': ['', 'стандарт', 'обычный', 'базовый']
+}
+
+MODEL_NUMBER_PATTERN = re.compile(r'(?<!\d)(1[1-6]|\d{1,2})(?!\d)')
+NON_DIGIT_PATTERN = re.compile(r'[^0-9]')
+NON_PRICE_PATTERN = re.compile(r'[^0-9.,]')
+# A comma or dot followed by exactly three digits groups thousands ("45,000", "1.299,99")
+THOUSANDS_SEPARATOR_PATTERN = re.compile(r'[.,](?=\d{3}(?!\d))')
+NUMBER_PATTERN = re.compile(r'\d+')
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+# Applied in order by normalize_model_name
+MODEL_REPLACEMENTS = {
+    'айфон': 'iphone',
+    'iphone': '',
+    'apple': '',
+    'series': '',
+    'model': '',
+    'gb': '',
+    'tb': '',
+    ' ': '',
+    '-': '',
+    'про': 'pro',
+    'макс': 'max',
+    'плюс': 'plus',
+    'мини': 'mini',
+    'стандарт': '',
+    'обычный': '',
+    'базовый': '',
+    'мии': 'mini',
+    'промакс': 'promax',
+    'промак': 'promax',
+    'плю': 'plus',
+    'min': 'mini',
+    'pro max': 'promax'
+}
+
+COLOR_MAP = {
+    'space gray': 'серый',
+    'spacegrey': 'серый',
+    'spacegray': 'серый',
+    'midnight': 'синий',
+    'starlight': 'золотой',
+    'gold': 'золотой',
+    'red': 'красный',
+    'blue': 'синий',
+    'black': 'черный',
+    'white': 'белый',
+    'purple': 'фиолетовый',
+    'green': 'зеленый',
+    'silver': 'серебристый',
+    'серый': 'серый',
+    'синий': 'синий',
+    'голубой': 'синий',
+    'золотой': 'золотой',
+    'красный': 'красный',
+    'черный': 'черный',
+    'белый': 'белый',
+    'фиолетовый': 'фиолетовый',
+    'зеленый': 'зеленый',
+    'серебристый': 'серебристый',
+    'розовый': 'розовый',
+    'темная ночь': 'синий',
+    'звездный свет': 'золотой',
+    'титан': 'титан',
+    'натуральный титан': 'титан',
+    'голубой титан': 'голубой титан',
+    'белый титан': 'белый титан',
+    'чёрный титан': 'чёрный титан'
+}
+
+def is_available(availability_str):
+    if not availability_str:
+        return False
+    avail = availability_str.strip().lower()
+    return avail in ['да', 'в наличии', 'yes', 'available', 'есть']
+
+def normalize_model_name(model_name):
+    if not model_name:
+        return ""
+    model = model_name.lower().translate(PUNCTUATION_TABLE)
+    for key, value in MODEL_REPLACEMENTS.items():
+        model = model.replace(key, value)
+    
+    model_number_match = MODEL_NUMBER_PATTERN.search(model)
+    model_number = model_number_match.group(0) if model_number_match else ""
+    
+    variant = ""
+    for var_type, patterns in MODEL_PATTERNS.items():
+        for pattern in patterns:
+            if pattern in model:
+                variant = var_type
+                break
+        if variant:
+            break
+    
+    # Handle special cases
+    if "promax" in model:
+        variant = "promax"
+    elif "max" in model and not variant:
+        variant = "max"
+    elif "pro" in model and not variant:
+        variant = "pro"
+    
+    return f"{model_number}{variant}"
+
+def normalize_storage(storage):
+    if not storage:
+        return ""
+    if isinstance(storage, str):
+        storage = storage.lower()
+        # Handle TB conversions
+        if 'tb' in storage or 'тб' in storage:
+            storage_num = NON_DIGIT_PATTERN.sub('', storage)
+            if storage_num == "1024" or storage_num == "1":
+                return "1TB"
+            return f"{storage_num}TB"
+        storage_num = NON_DIGIT_PATTERN.sub('', storage)
+        if storage_num == "1024":
+            return "1TB"
+        return f"{storage_num} ГБ" if storage_num else ""
+    return f"{storage} ГБ"
+
+def normalize_color(color):
+    if not color:
+        return ""
+    color = color.lower()
+    if color in COLOR_MAP:
+        return COLOR_MAP[color]
+    best_match = None
+    best_score = 0
+    for key in COLOR_MAP:
+        score = jellyfish.jaro_similarity(color, key)
+        if score > 0.85 and score > best_score:
+            best_match = key
+            best_score = score
+    return COLOR_MAP[best_match] if best_match else color
+
+def find_matching_products(products, model=None, storage=None, color=None):
+    results = []
+    for product in products:
+        if not is_available(product.get('Наличие', '')):
+            continue
+        match_score = 0
+        if model:
+            input_norm = normalize_model_name(model)
+            product_norm = normalize_model_name(product.get('Модель', ''))
+            if input_norm == product_norm:
+                match_score += 100
+            elif input_norm in product_norm or product_norm in input_norm:
+                match_score += 75
+            else:
+                input_nums = set(NUMBER_PATTERN.findall(input_norm))
+                product_nums = set(NUMBER_PATTERN.findall(product_norm))
+                if input_nums and input_nums.issubset(product_nums):
+                    match_score += 50
+                elif input_nums and product_nums and input_nums == product_nums:
+                    match_score += 40
+        if storage:
+            input_norm = normalize_storage(storage)
+            product_norm = normalize_storage(product.get('Объём', ''))
+            if input_norm == product_norm:
+                match_score += 20
+        if color:
+            input_norm = normalize_color(color)
+            product_norm = normalize_color(product.get('Цвет', ''))
+            if input_norm == product_norm:
+                match_score += 10
+        if (model or storage or color) and match_score >= 50:
+            results.append((product, match_score))
+    results.sort(key=lambda x: x[1], reverse=True)
+    return [item[0] for item in results]
+
+def get_available_storages(products, model):
+    if isinstance(products, ColumnarCatalog):
+        return products.distinct('storage', products.filter(model=model))
+    return list(set(
+        p['Объём'] for p in products
+        if is_available(p.get('Наличие', '')) and
+        normalize_model_name(p.get('Модель', '')) == normalize_model_name(model)
+    ))
+
+def get_available_colors(products, model, storage):
+    if isinstance(products, ColumnarCatalog):
+        return products.distinct('color', products.filter(model=model, storage=storage))
+    return list(set(
+        p['Цвет'] for p in products
+        if is_available(p.get('Наличие', '')) and
+        normalize_model_name(p.get('Модель', '')) == normalize_model_name(model) and
+        normalize_storage(p.get('Объём', '')) == normalize_storage(storage)
+    ))
+
+def parse_storage_gb(storage):
+    """Storage size in GB as a number, NaN if it cannot be parsed"""
+    normalized = normalize_storage(storage)
+    digits = NON_DIGIT_PATTERN.sub('', normalized)
+    if not digits:
+        return math.nan
+    return float(digits) * (1024 if 'TB' in normalized else 1)
+
+def parse_price(price):
+    if isinstance(price, (int, float)):
+        return float(price)
+    # Spaces and NBSP go with the currency signs; the remaining comma is decimal
+    digits = NON_PRICE_PATTERN.sub('', str(price or '')).strip('.,')
+    digits = THOUSANDS_SEPARATOR_PATTERN.sub('', digits).replace(',', '.')
+    try:
+        return float(digits)
+    except ValueError:
+        return math.nan
+
+def rows_to_mask(rows):
+    """Bitmask with the given ascending row indexes set"""
+    if not rows:
+        return 0
+    base = rows[0] & ~7
+    bits = bytearray(((rows[-1] - base) >> 3) + 1)
+    for row in rows:
+        row -= base
+        bits[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(bits, 'little') << base
+
+def iter_rows(mask):
+    """Row indexes of the set bits in a mask, lowest first"""
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+class ColumnarCatalog:
+    """Column-oriented snapshot of the product catalog.
+
+    Every field is parsed and normalized once into a bitmap index mapping a
+    value to an int whose set bits are the matching rows. Numeric columns
+    (storage in GB, price) also keep their distinct values sorted for range
+    queries. Filters combine those bitmaps with bitwise AND/OR, so a
+    multi-attribute query costs a few big-int operations instead of a Python
+    loop over every row.
+    """
+    PRICE_COLUMN = 'Цена'
+
+    def __init__(self, records):
+        self.records = list(records)
+        self.size = len(self.records)
+        self.all_rows = (1 << self.size) - 1
+        postings = {
+            'model': {}, 'model_key': {}, 'storage': {}, 'storage_key': {},
+            'color': {}, 'color_key': {}, 'storage_gb': {}, 'price': {}
+        }
+        in_stock = []
+        # Raw cell values repeat across rows, so each is normalized only once
+        model_keys, storage_keys, color_keys, storage_gbs = {}, {}, {}, {}
+        for row, record in enumerate(self.records):
+            model = record.get('Модель', '')
+            storage = record.get('Объём', '')
+            color = record.get('Цвет', '')
+            if model not in model_keys:
+                model_keys[model] = normalize_model_name(model)
+            if storage not in storage_keys:
+                storage_keys[storage] = normalize_storage(storage)
+                storage_gbs[storage] = parse_storage_gb(storage)
+            if color not in color_keys:
+                color_keys[color] = normalize_color(color)
+            for column, value in (
+                ('model', model), ('model_key', model_keys[model]),
+                ('storage', storage), ('storage_key', storage_keys[storage]),
+                ('color', color), ('color_key', color_keys[color]),
+                ('storage_gb', storage_gbs[storage]),
+                ('price', parse_price(record.get(self.PRICE_COLUMN)))
+            ):
+                # NaN never equals itself, so unparsed numbers are not indexed
+                if value == value:
+                    postings[column].setdefault(value, []).append(row)
+            if is_available(record.get('Наличие', '')):
+                in_stock.append(row)
+        # Masks are built once per value from the row lists; OR-ing one bit
+        # at a time into a growing int would copy it on every row
+        self.indexes = {
+            column: {value: rows_to_mask(rows) for value, rows in values.items()}
+            for column, values in postings.items()
+        }
+        self.in_stock = rows_to_mask(in_stock)
+        self.sorted_values = {
+            column: sorted(self.indexes[column]) for column in ('storage_gb', 'price')
+        }
+
+    def __len__(self):
+        return self.size
+
+    def range_mask(self, column, minimum=None, maximum=None):
+        """Rows whose numeric column lies within [minimum, maximum]"""
+        values = self.sorted_values[column]
+        start = 0 if minimum is None else bisect.bisect_left(values, minimum)
+        end = len(values) if maximum is None else bisect.bisect_right(values, maximum)
+        index = self.indexes[column]
+        mask = 0
+        for value in values[start:end]:
+            mask |= index[value]
+        return mask
+
+    def filter(self, model=None, storage=None, color=None, in_stock=True,
+               min_storage_gb=None, max_storage_gb=None, min_price=None, max_price=None):
+        """Bitmask of rows matching every given condition"""
+        mask = self.in_stock if in_stock else self.all_rows
+        if model:
+            mask &= self.indexes['model_key'].get(normalize_model_name(model), 0)
+        if storage:
+            mask &= self.indexes['storage_key'].get(normalize_storage(storage), 0)
+        if color:
+            mask &= self.indexes['color_key'].get(normalize_color(color), 0)
+        if min_storage_gb is not None or max_storage_gb is not None:
+            mask &= self.range_mask('storage_gb', min_storage_gb, max_storage_gb)
+        if min_price is not None or max_price is not None:
+            mask &= self.range_mask('price', min_price, max_price)
+        return mask
+
+    def distinct(self, column, mask):
+        """Values of a column present in the masked rows"""
+        return [value for value, rows in self.indexes[column].items() if rows & mask]
+
+    def count(self, mask):
+        return bin(mask).count('1')
+
+    def rows(self, mask, sort_by=None, descending=False, limit=None):
+        """Records for the masked rows, optionally sorted by a numeric column.
+        Rows with no value in the sort column come last."""
+        if sort_by is None:
+            selected = iter_rows(mask)
+        else:
+            ordered_values = self.sorted_values[sort_by]
+            if descending:
+                ordered_values = reversed(ordered_values)
+            index = self.indexes[sort_by]
+            selected = itertools.chain(
+                (row for value in ordered_values for row in iter_rows(index[value] & mask)),
+                iter_rows(mask & ~self.range_mask(sort_by))
+            )
+        return [self.records[row] for row in itertools.islice(selected, limit)]
+
+def find_similar_models(user_input, available_models):
+    user_input_norm = normalize_model_name(user_input)
+    suggestions = []
+    seen = set()
+    for model in available_models:
+        norm_model = normalize_model_name(model)
+        if user_input_norm in norm_model or norm_model in user_input_norm:
+            if model not in seen:
+                suggestions.append(model)
+                seen.add(model)
+    if not suggestions:
+        numbers = NUMBER_PATTERN.findall(user_input)
+        if numbers:
+            for model in available_models:
+                model_numbers = NUMBER_PATTERN.findall(model)
+                if any(num in model_numbers for num in numbers):
+                    if model not in seen:
+                        suggestions.append(model)
+                        seen.add(model)
+    if not suggestions:
+        for model in available_models:
+            norm_model = normalize_model_name(model)
+            match = True
+            for keyword, patterns in MODEL_PATTERNS.items():
+                if keyword in norm_model:
+                    if not any(pattern in user_input_norm for pattern in patterns):
+                        match = False
+                        break
+            if match and model not in seen:
+                suggestions.append(model)
+                seen.add(model)
+    if not suggestions:
+        similarity_scores = []
+        for model in available_models:
+            norm_model = normalize_model_name(model)
+            similarity = jellyfish.jaro_similarity(user_input_norm, norm_model)
+            if similarity > 0.85:
+                similarity_scores.append((model, similarity))
+        similarity_scores.sort(key=lambda x: x[1], reverse=True)
+        suggestions = [item[0] for item in similarity_scores]
+    if not suggestions:
+        suggestions = difflib.get_close_matches(
+            user_input,
+            available_models,
+            n=3,
+            cutoff=0.7
+        )
+    return suggestions[:3]
+
+MODEL_EXTRACTION_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE) for pattern in [
+        r'\b(?:iphone|айфон|phone)\s*(\d{1,2})\s*(pro\s*max|pro|plus|mini|max)?\b',
+        r'\b(\d{1,2})\s*(pro\s*max|pro|plus|mini|max|мини|мин|мии|про|плюс)\b',
+        r'\b(?:iphone|айфон)\s*(\d{1,2})\b',
+        r'\b(?:айфон|айфона|айфоном)\s*(\d{1,2})\s*(про|макс|мини|плюс)?\b',
+        r'\b(?:iphone|айфон)(\d{1,2})\s*(pro\s*max|pro|plus|mini|max)?\b'
+    ]
+]
+MODEL_VARIANT_NAMES = {
+    'мин': 'mini', 'мини': 'mini', 'мии': 'mini',
+    'про': 'pro', 'плюс': 'plus', 'макс': 'max'
+}
+
+def extract_models_from_input(user_input):
+    models = []
+    for pattern in MODEL_EXTRACTION_PATTERNS:
+        matches = pattern.findall(user_input)
+        for match in matches:
+            if isinstance(match, tuple):
+                number = match[0]
+                variant = match[1] if len(match) > 1 else ""
+            else:
+                number = match
+                variant = ""
+            variant = MODEL_VARIANT_NAMES.get(variant.lower(), variant.lower())
+            model_name = f"iPhone {number}"
+            if variant:
+                model_name += f" {variant.capitalize()}"
+            models.append(model_name)
+    seen = set()
+    return [m for m in models if not (m in seen or seen.add(m))]
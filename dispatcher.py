@@ -0,0 +1,253 @@
+"""Session-affinity dispatcher for running the bot on several processes.
+
+Sessions live in per-process memory, so every request of a session must reach
+the process that created it. The dispatcher starts N single-worker gunicorn
+servers of the app (with gunicorn.conf.py) on local ports and proxies requests
+to them, choosing the worker from a consistent hash ring over session_id.
+Changing the worker count only moves the sessions that hash to the added or
+removed ring segments.
+
+The dispatcher itself is served by gunicorn too, in a single process because
+it owns the worker pool:
+
+    python dispatcher.py --workers 4 --port 10000
+
+which runs
+
+    WORKERS=4 gunicorn --workers 1 --threads 32 --bind 0.0.0.0:10000 \\
+        'dispatcher:create_dispatcher_from_env()'
+"""
+import os
+import sys
+import json
+import uuid
+import time
+import bisect
+import hashlib
+import atexit
+import argparse
+import logging
+import itertools
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import Flask, request, jsonify, Response
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+GUNICORN_CONFIG_PATH = os.path.join(APP_DIR, 'gunicorn.conf.py')
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'content-length', 'host'
+}
+PROXY_TIMEOUT = 120  # seconds; LLM replies can take a while under load
+DISPATCHER_THREADS = 32
+
+class HashRing:
+    """Consistent hash ring with virtual nodes"""
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.ring = []
+        self.ring_nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash_key(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        for replica in range(self.replicas):
+            point = self.hash_key(f"{node}#{replica}")
+            bisect.insort(self.ring, point)
+            self.ring_nodes[point] = node
+
+    def remove_node(self, node):
+        for replica in range(self.replicas):
+            point = self.hash_key(f"{node}#{replica}")
+            self.ring.remove(point)
+            del self.ring_nodes[point]
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.ring, self.hash_key(key)) % len(self.ring)
+        return self.ring_nodes[self.ring[index]]
+
+class WorkerPool:
+    """Starts one-worker gunicorn servers of the app and restarts them if they exit"""
+    def __init__(self, count, base_port):
+        self.ports = [base_port + index for index in range(count)]
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def start_worker(self, port):
+        env = dict(os.environ, PORT=str(port), SESSION_AFFINITY_WORKER='1')
+        # One worker per port: sessions must stay in the process that made them
+        command = [
+            sys.executable, '-m', 'gunicorn',
+            '--config', GUNICORN_CONFIG_PATH,
+            '--chdir', APP_DIR,
+            '--bind', f'127.0.0.1:{port}',
+            '--workers', '1'
+        ]
+        self.processes[port] = subprocess.Popen(command, env=env)
+        logger.info("Started worker on port %s (pid %s)", port, self.processes[port].pid)
+
+    def start(self):
+        with self.lock:
+            for port in self.ports:
+                self.start_worker(port)
+        threading.Thread(target=self.monitor, name="worker-monitor", daemon=True).start()
+
+    def monitor(self):
+        while True:
+            time.sleep(2)
+            with self.lock:
+                for port, process in self.processes.items():
+                    if process.poll() is not None:
+                        logger.warning("Worker on port %s exited with %s, restarting", port, process.returncode)
+                        self.start_worker(port)
+
+    def stop(self):
+        with self.lock:
+            for process in self.processes.values():
+                process.terminate()
+
+def create_dispatcher(worker_urls):
+    dispatcher = Flask(__name__)
+    ring = HashRing(worker_urls)
+    round_robin = itertools.cycle(worker_urls)
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(worker_urls), pool_maxsize=64)
+    http.mount('http://', adapter)
+
+    def forward(worker_url, extra_headers=None, body=None):
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS
+        }
+        headers.update(extra_headers or {})
+        try:
+            upstream = http.request(
+                request.method,
+                f"{worker_url}{request.full_path if request.query_string else request.path}",
+                headers=headers,
+                data=request.get_data() if body is None else body,
+                stream=True,
+                timeout=PROXY_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error("Worker %s unavailable: %s", worker_url, e)
+            return jsonify({"error": "Worker unavailable"}), 502
+        # Pass the body through untouched, including any compression
+        content = upstream.raw.read(decode_content=False)
+        response_headers = [
+            (name, value) for name, value in upstream.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        return Response(content, status=upstream.status_code, headers=response_headers)
+
+    @dispatcher.route('/start_chat', methods=['POST'])
+    def start_chat():
+        # Session ids carry the store id, the same way the workers build them
+        data = request.get_json(silent=True) or {}
+        store_id = str(data.get('store_id') or request.args.get('store') or 'default')
+        session_id = f"{store_id}:{uuid.uuid4()}"
+        return forward(ring.get_node(session_id), {'X-Session-Id': session_id})
+
+    @dispatcher.route('/send_message', methods=['POST'])
+    def send_message():
+        data = request.get_json(silent=True) or {}
+        session_id = data.get('session_id')
+        if not session_id:
+            return jsonify({"error": "Invalid session"}), 400
+        return forward(ring.get_node(str(session_id)))
+
+    @dispatcher.route('/send_messages', methods=['POST'])
+    def send_messages():
+        data = request.get_json(silent=True) or {}
+        items = data.get('messages')
+        if not isinstance(items, list):
+            return jsonify({"error": "messages must be a list"}), 400
+        # Split the batch by worker, keeping each session's order
+        worker_batches = {}
+        for index, item in enumerate(items):
+            session_id = item.get('session_id') if isinstance(item, dict) else None
+            worker_url = ring.get_node(str(session_id))
+            worker_batches.setdefault(worker_url, []).append((index, item))
+        replies = [None] * len(items)
+
+        def send_batch(worker_url, indexed_items):
+            try:
+                upstream = http.post(
+                    f"{worker_url}/send_messages",
+                    json={"messages": [item for _, item in indexed_items]},
+                    timeout=PROXY_TIMEOUT
+                )
+                worker_replies = upstream.json().get('replies')
+                if worker_replies is None:
+                    raise ValueError(upstream.json().get('error', 'no replies'))
+            except Exception as e:
+                logger.error("Batch to worker %s failed: %s", worker_url, e)
+                worker_replies = [
+                    {"session_id": item.get('session_id') if isinstance(item, dict) else None,
+                     "error": "Worker unavailable"}
+                    for _, item in indexed_items
+                ]
+            for (index, _), reply in zip(indexed_items, worker_replies):
+                replies[index] = reply
+
+        with ThreadPoolExecutor(max_workers=max(1, len(worker_batches))) as executor:
+            for worker_url, indexed_items in worker_batches.items():
+                executor.submit(send_batch, worker_url, indexed_items)
+        return jsonify({"replies": replies})
+
+    @dispatcher.route('/', defaults={'path': ''}, methods=['GET', 'POST'])
+    @dispatcher.route('/<path:path>', methods=['GET', 'POST'])
+    def passthrough(path):
+        # Session-independent routes go to any worker
+        return forward(next(round_robin))
+
+    return dispatcher
+
+def create_dispatcher_from_env():
+    """WSGI entry point: start the worker pool from WORKERS and
+    WORKER_BASE_PORT, and return the dispatcher app"""
+    pool = WorkerPool(
+        int(os.getenv("WORKERS", os.cpu_count() or 2)),
+        int(os.getenv("WORKER_BASE_PORT", "10100"))
+    )
+    pool.start()
+    atexit.register(pool.stop)
+    worker_urls = [f"http://127.0.0.1:{port}" for port in pool.ports]
+    logger.info("Dispatching to %d workers: %s", len(worker_urls), json.dumps(worker_urls))
+    return create_dispatcher(worker_urls)
+
+def main():
+    parser = argparse.ArgumentParser(description="Session-affinity dispatcher")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", os.cpu_count() or 2)))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "10000")))
+    parser.add_argument("--worker-base-port", type=int, default=int(os.getenv("WORKER_BASE_PORT", "10100")))
+    args = parser.parse_args()
+
+    os.environ["WORKERS"] = str(args.workers)
+    os.environ["WORKER_BASE_PORT"] = str(args.worker_base_port)
+    os.chdir(APP_DIR)
+    os.execv(sys.executable, [
+        sys.executable, '-m', 'gunicorn',
+        '--workers', '1',
+        '--threads', str(DISPATCHER_THREADS),
+        '--timeout', str(PROXY_TIMEOUT + 10),
+        '--bind', f'0.0.0.0:{args.port}',
+        'dispatcher:create_dispatcher_from_env()'
+    ])
+
+if __name__ == '__main__':
+    main()
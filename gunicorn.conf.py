@@ -0,0 +1,27 @@
+"""gunicorn settings: preload shared data in the master, per-worker resources after fork.
+
+    gunicorn -c gunicorn.conf.py
+
+Set GUNICORN_PRELOAD=0 to load the app separately in every worker instead.
+"""
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))  # LLM replies can take a while
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+wsgi_app = "app:create_app(preload=True)" if preload_app else "app:create_app()"
+
+def post_fork(server, worker):
+    if preload_app:
+        from gunicorn.arbiter import Arbiter
+        import app
+        try:
+            app.init_worker()
+        except Exception:
+            # Fail the boot like a failed import would, instead of serving
+            # 500s and retrying the connection on every request
+            server.log.exception("Worker initialization failed")
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
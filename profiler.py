@@ -0,0 +1,69 @@
+"""Statistical wall-clock sampler over all threads of this process.
+
+A background thread reads sys._current_frames() every `interval` seconds and
+counts each thread's stack. Nothing is installed while no profile is running,
+so the app pays nothing outside a profiling window. Output is in the
+collapsed-stack format ("frame;frame;frame count") read by flamegraph.pl,
+speedscope and similar tools.
+"""
+import sys
+import time
+import threading
+from collections import Counter
+
+profile_lock = threading.Lock()
+
+def frame_label(frame):
+    """module:function, e.g. catalog:normalize_model_name or requests.sessions:post"""
+    module = frame.f_globals.get('__name__', '?')
+    return f"{module}:{frame.f_code.co_name}"
+
+def collapse_stack(frame, max_depth):
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+def sample_stacks(seconds, interval=0.005, by_thread=True, max_depth=64):
+    """Sample every thread except the sampler and the caller.
+    Returns (Counter of collapsed stacks, number of sampling rounds)."""
+    counts = Counter()
+    ignored = {threading.get_ident()}
+    rounds = 0
+
+    def run():
+        nonlocal rounds
+        ignored.add(threading.get_ident())
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignored:
+                    continue
+                stack = collapse_stack(frame, max_depth)
+                if by_thread:
+                    stack = f"{thread_names.get(thread_id, thread_id)};{stack}"
+                counts[stack] += 1
+            rounds += 1
+            time.sleep(interval)
+
+    sampler = threading.Thread(target=run, name="profiler-sampler", daemon=True)
+    sampler.start()
+    sampler.join()
+    return counts, rounds
+
+def format_collapsed(counts):
+    return "".join(
+        f"{stack} {count}\n" for stack, count in counts.most_common()
+    )
+
+def profile(seconds, interval=0.005, by_thread=True):
+    """Run one profile; returns None if another one is already running"""
+    if not profile_lock.acquire(blocking=False):
+        return None
+    try:
+        return sample_stacks(seconds, interval, by_thread)
+    finally:
+        profile_lock.release()
@@ -0,0 +1,27 @@
+import math
+
+import pytest
+
+from catalog import parse_price
+
+
+@pytest.mark.parametrize("raw, expected", [
+    (45000, 45000.0),
+    ("45000", 45000.0),
+    ("45 000", 45000.0),
+    ("45 000 ₽", 45000.0),
+    ("45,000", 45000.0),
+    ("45.000", 45000.0),
+    ("45,000.00", 45000.0),
+    ("1.299,99", 1299.99),
+    ("1 299,99 руб.", 1299.99),
+    ("45 000,5", 45000.5),
+    ("99.90", 99.9),
+])
+def test_parse_price_formats(raw, expected):
+    assert parse_price(raw) == expected
+
+
+@pytest.mark.parametrize("raw", ["", None, "по запросу"])
+def test_parse_price_missing(raw):
+    assert math.isnan(parse_price(raw))
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import app
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def faq_index():
+    return app.build_faq_index(REPO_DIR)
+
+
+@pytest.mark.parametrize("query", [
+    "давайте",
+    "не подходит",
+    "где магазин?",
+    "какой аккумулятор?",
+])
+def test_weak_matches_are_not_answered_directly(faq_index, query):
+    assert app.find_direct_faq_answer(faq_index.search(query), query) is None
+
+
+def test_lead_in_and_prompt_lines_are_never_answers(faq_index):
+    for passage in faq_index.passages:
+        if passage.endswith(("?", ":")):
+            results = [(10.0, passage, 1.0)]
+            assert app.find_direct_faq_answer(results, "подходит такой вариант") is None
+
+
+def test_specific_question_is_answered_directly(faq_index):
+    query = "есть доставка курьером?"
+    answer = app.find_direct_faq_answer(faq_index.search(query), query)
+    assert answer and "Курьерская доставка" in answer
+
+
+def test_last_assistant_message():
+    history = [
+        {"role": "assistant", "content": "iPhone 15 Pro есть в наличии. Оформим заказ? "},
+        {"role": "user", "content": "давайте"},
+    ]
+    assert app.last_assistant_message(history) == "iPhone 15 Pro есть в наличии. Оформим заказ?"
+    assert app.last_assistant_message([]) == ""